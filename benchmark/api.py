@@ -0,0 +1,54 @@
+# Times fetching the HAProxy container and service from a local stub of the Tutum API, one new connection and one
+# request after the other as python-tutum does, against the pooled and concurrent ApiClient. The last run goes through
+# failing requests to show the retries.
+import logging
+import time
+
+import requests
+
+from topology import CONTAINER_URI, SERVICE_URI
+from tutum_stub import start, topology_resources
+
+ROUNDS = 20
+LATENCY = 0.05  # seconds
+
+
+def fetch_serially(url):
+    for uri in [CONTAINER_URI, SERVICE_URI]:
+        session = requests.Session()
+        session.get(url + uri).json()
+        session.close()
+
+
+def main():
+    from api import ApiClient
+
+    logging.basicConfig()
+    logging.getLogger("haproxy").setLevel(logging.WARNING)
+    server = start(topology_resources(10, 2, 2), LATENCY)
+    url = server.get_url()
+
+    for name, fetch in [("serial, new connections", lambda: fetch_serially(url)),
+                        ("ApiClient.fetch_all", lambda: client.fetch_all([CONTAINER_URI, SERVICE_URI]))]:
+        client = ApiClient(url, {})
+        server.requests = server.connections = 0
+        start_time = time.time()
+        for _ in range(ROUNDS):
+            fetch()
+        elapsed = time.time() - start_time
+        print("%-24s %8.1f ms/round %4d requests %4d connections" % (
+            name, elapsed * 1000 / ROUNDS, server.requests, server.connections))
+
+    server.failure_rate = 0.5
+    server.requests = 0
+    client = ApiClient(url, {}, backoff=0.01, budget=5)
+    start_time = time.time()
+    for _ in range(ROUNDS):
+        client.fetch_all([CONTAINER_URI, SERVICE_URI])
+    print("%-24s %8.1f ms/round %4d requests for %d resources" % (
+        "50% failures", (time.time() - start_time) * 1000 / ROUNDS, server.requests, ROUNDS * 2))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Times polling the HAProxy statistics from a stub of the stats socket, with a new connection for every command as the
+# runtime API does, against the persistent connection of the exporter, and then the scrapes of the exporter.
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haproxy"))
+
+from stats_stub import start
+
+ROUNDS = 200
+SERVICES = 100
+CONTAINERS = 3
+
+
+def main():
+    from metrics import Exporter, Sample, parse_info, parse_stat, render
+    from runtime import RuntimeApi
+
+    tmp_dir = tempfile.mkdtemp(prefix="haproxy-benchmark-")
+    stub = start(os.path.join(tmp_dir, "haproxy.stats"), SERVICES, CONTAINERS)
+
+    runtime = RuntimeApi(stub.socket_path)
+    start_time = time.time()
+    for _ in range(ROUNDS):
+        render(parse_info(runtime.execute("show info")) + parse_stat(runtime.execute("show stat")))
+    print("%-24s %8.3f ms/poll %4d connections" % (
+        "new connections", (time.time() - start_time) * 1000 / ROUNDS, stub.connections))
+
+    stub.connections = 0
+    exporter = Exporter(0, stub.socket_path, 3600, [lambda: [Sample("controller", "gauge", "A sample", (), 1)]],
+                        lambda: stub.pid)
+    start_time = time.time()
+    for _ in range(ROUNDS):
+        exporter.poll()
+    print("%-24s %8.3f ms/poll %4d connections, %d samples" % (
+        "persistent connection", (time.time() - start_time) * 1000 / ROUNDS, stub.connections, len(exporter.samples)))
+
+    # a reload: the exporter connects to the new process
+    stub.pid += 1
+    exporter.poll()
+    print("%-24s %4d connections" % ("after a reload", stub.connections))
+
+    exporter.start()
+    url = "http://127.0.0.1:%d/metrics" % exporter.server.server_address[1]
+    start_time = time.time()
+    for _ in range(ROUNDS // 10):
+        content = urllib2.urlopen(url).read()
+    print("%-24s %8.3f ms/scrape %4d bytes" % (
+        "scrape", (time.time() - start_time) * 1000 / (ROUNDS // 10), len(content)))
+    exporter.server.shutdown()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# A local stand-in for the HAProxy stats socket, answering "show info" and "show stat" for a synthetic set of
+# frontends, backends and servers, in one-shot and interactive ("prompt") mode. It counts the connections it accepts,
+# to exercise the metrics exporter without HAProxy:
+#
+#   python benchmark/stats_stub.py --socket /tmp/haproxy.stats --topology 100x3
+#
+# and then run the exporter against it with METRICS_PORT=9101 and the stats socket pointing to /tmp/haproxy.stats
+import argparse
+import os
+import socket
+import threading
+
+STAT_HEADER = ("# pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,dreq,dresp,ereq,econ,eresp,wretr,wredis,"
+               "status,weight,act,bck,chkfail,chkdown,lastchg,downtime,qlimit,pid,iid,sid,throttle,lbtot,tracked,"
+               "type,rate,rate_lim,rate_max,check_status,check_code,check_duration,hrsp_1xx,hrsp_2xx,hrsp_3xx,"
+               "hrsp_4xx,hrsp_5xx,hrsp_other,hanafail,req_rate,req_rate_max,req_tot,cli_abrt,srv_abrt,comp_in,"
+               "comp_out,comp_byp,comp_rsp,lastsess,last_chk,last_agt,qtime,ctime,rtime,ttime,")
+FIELDS = STAT_HEADER[2:].rstrip(",").split(",")
+
+
+def stat_row(**values):
+    return ",".join(str(values.get(field, "")) for field in FIELDS) + ","
+
+
+def show_stat(services, containers):
+    rows = [STAT_HEADER,
+            stat_row(pxname="port_80", svname="FRONTEND", scur=12, slim=4096, stot=1000, bin=123456, bout=654321,
+                     status="OPEN", type=0, rate=5, hrsp_2xx=900, hrsp_5xx=3, req_tot=903)]
+    for service in range(services):
+        backend = "SERVICE_WEB_%d" % service
+        for container in range(containers):
+            rows.append(stat_row(pxname=backend, svname="WEB_%d_%d" % (service, container + 1), scur=1, stot=100,
+                                 bin=1234, bout=4321, status="UP" if container else "DOWN", weight=1, chkfail=2,
+                                 downtime=30, type=2, rate=1, hrsp_2xx=90, req_tot=90, qtime=0, ctime=1, rtime=12,
+                                 ttime=15))
+        rows.append(stat_row(pxname=backend, svname="BACKEND", scur=containers, stot=100 * containers,
+                             bin=1234 * containers, bout=4321 * containers, status="UP", weight=containers, type=1,
+                             rate=containers, hrsp_2xx=90 * containers, req_tot=90 * containers, qtime=0, ctime=1,
+                             rtime=12, ttime=15))
+    return "\n".join(rows) + "\n\n"
+
+
+class StatsStub(object):
+    def __init__(self, socket_path, services=10, containers=2, pid=1234):
+        self.socket_path = socket_path
+        self.pid = pid
+        self.stat = show_stat(services, containers)
+        self.connections = 0
+        self.commands = 0
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socket_path)
+        self.sock.listen(16)
+
+    def serve_forever(self):
+        while True:
+            connection, _ = self.sock.accept()
+            self.connections += 1
+            worker = threading.Thread(target=self.handle, args=(connection,))
+            worker.daemon = True
+            worker.start()
+
+    def handle(self, connection):
+        # a connection stays with the process it was opened to, which a reload replaces by a new pid
+        pid = self.pid
+        interactive = False
+        reader = connection.makefile("r")
+        try:
+            for line in reader:
+                command = line.strip()
+                self.commands += 1
+                if command == "prompt":
+                    interactive = True
+                    response = ""
+                elif command == "show info":
+                    response = "Name: HAProxy\nVersion: 1.5.18\nPid: %d\nUptime_sec: 3600\nMaxconn: 4096\n" \
+                               "CurrConns: 12\nConnRate: 5\nIdle_pct: 97\n\n" % pid
+                elif command == "show stat":
+                    response = self.stat
+                else:
+                    response = "Unknown command.\n"
+                connection.sendall(response + ("\n> " if interactive else ""))
+                if not interactive:
+                    break
+        except socket.error:
+            pass
+        finally:
+            reader.close()
+            connection.close()
+
+
+def start(socket_path, services=10, containers=2):
+    stub = StatsStub(socket_path, services, containers)
+    worker = threading.Thread(target=stub.serve_forever, name="stats-stub")
+    worker.daemon = True
+    worker.start()
+    return stub
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Serve synthetic statistics on a HAProxy stats socket")
+    arg_parser.add_argument("--socket", default="/tmp/haproxy.stats")
+    arg_parser.add_argument("--topology", default="10x2", help="SERVICESxCONTAINERS")
+    args = arg_parser.parse_args()
+
+    services, containers = [int(count) for count in args.topology.lower().split("x")]
+    stub = StatsStub(args.socket, services, containers)
+    print("Serving statistics on %s" % args.socket)
+    stub.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
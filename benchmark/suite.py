@@ -0,0 +1,170 @@
+# Times every stage of the configuration generation on synthetic topologies and prints the results as JSON, so that
+# they can be kept and compared between releases:
+#
+#   python benchmark/suite.py --topology 100x3x4 --topology 1000x1x1x4 --rounds 5 --output results.json
+#
+# A topology is SERVICESxCONTAINERSxVHOSTS[xPORTS]. Each one is generated from the environment variables
+# (local mode) and from Tutum objects (Tutum mode), and HAProxy itself is never launched.
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from topology import tutum_topology, link_envvars, create_haproxy, create_local_haproxy, reset_haproxy
+
+DEFAULT_TOPOLOGIES = ["10x2x2", "100x3x4", "500x2x4x4"]
+
+
+class FakeProcess(object):
+    pid = 0
+    returncode = 0
+
+    def communicate(self):
+        return "", None
+
+    def wait(self):
+        return 0
+
+
+@contextlib.contextmanager
+def environment(envvars):
+    saved = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(envvars)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+@contextlib.contextmanager
+def sandbox():
+    # Writes the configuration, the certificates and the maps to a temporary directory and stubs the process launch
+    from haproxy import Haproxy
+
+    tmp_dir = tempfile.mkdtemp(prefix="haproxy-benchmark-")
+    saved = (Haproxy.const_config_file, Haproxy.const_cert_dir, Haproxy.const_cacert_dir, Haproxy.const_map_dir,
+             subprocess.Popen)
+    Haproxy.const_config_file = os.path.join(tmp_dir, "haproxy.cfg")
+    Haproxy.const_cert_dir = os.path.join(tmp_dir, "certs/")
+    Haproxy.const_cacert_dir = os.path.join(tmp_dir, "cacerts/")
+    Haproxy.const_map_dir = os.path.join(tmp_dir, "maps/")
+    subprocess.Popen = lambda *args, **kwargs: FakeProcess()
+    try:
+        yield
+    finally:
+        (Haproxy.const_config_file, Haproxy.const_cert_dir, Haproxy.const_cacert_dir, Haproxy.const_map_dir,
+         subprocess.Popen) = saved
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def timed(timings, stage, func, *args):
+    start = time.time()
+    result = func(*args)
+    timings.setdefault(stage, []).append(time.time() - start)
+    return result
+
+
+def run_round(timings, mode, container, service):
+    from haproxy import Haproxy
+    from parser import Specs
+
+    if mode == "tutum":
+        timed(timings, "specs", Specs, container, service)
+        create = lambda: create_haproxy(container, service)
+    else:
+        timed(timings, "specs", Specs)
+        create = create_local_haproxy
+
+    # every stage from scratch, in the order of Haproxy.update
+    haproxy = create()
+    Haproxy.cls_sections.clear()
+    timed(timings, "config_ssl", haproxy._config_ssl)
+    timed(timings, "config_global", haproxy._config_global_defaults)
+    timed(timings, "config_tcp", haproxy._config_tcp)
+    timed(timings, "config_frontend", haproxy._config_frontend)
+    timed(timings, "config_backend", haproxy._config_backend)
+
+    Haproxy.cls_sections.clear()
+    cfg_dict = timed(timings, "config", haproxy._config)
+    timed(timings, "config_cached", haproxy._config)
+    timed(timings, "prettify", haproxy._prettify, cfg_dict)
+    timed(timings, "save_conf", haproxy._save_conf, cfg_dict, False)
+
+    reset_haproxy()
+    timed(timings, "update", lambda: create().update())
+    if mode == "tutum":
+        # an event that does not change anything, as the update following a redeployment of the same containers
+        timed(timings, "update_unchanged", lambda: Haproxy(set()).update())
+
+
+def bench(mode, services, containers, vhosts, ports, rounds):
+    container, service = tutum_topology(services, containers, vhosts, ports)
+    envvars = link_envvars(services, containers, vhosts, ports)
+    timings = {}
+    with environment(envvars if mode == "local" else {}), sandbox():
+        for _ in range(rounds):
+            run_round(timings, mode, container, service)
+    reset_haproxy()
+
+    stages = {}
+    for stage, values in timings.iteritems():
+        stages[stage] = {"best_ms": round(min(values) * 1000, 3),
+                         "mean_ms": round(sum(values) * 1000 / len(values), 3)}
+    return {"mode": mode, "services": services, "containers": containers, "vhosts": vhosts, "ports": ports,
+            "envvars": len(envvars), "stages": stages}
+
+
+def parse_topology(value):
+    try:
+        counts = [int(count) for count in value.lower().split("x")]
+    except ValueError:
+        counts = []
+    if len(counts) not in (3, 4):
+        raise argparse.ArgumentTypeError("expected SERVICESxCONTAINERSxVHOSTS[xPORTS], got %s" % value)
+    return tuple(counts) if len(counts) == 4 else tuple(counts + [1])
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the generation of the HAProxy configuration")
+    arg_parser.add_argument("--topology", action="append", type=parse_topology,
+                            help="SERVICESxCONTAINERSxVHOSTS[xPORTS], can be repeated (default: %s)" %
+                                 " ".join(DEFAULT_TOPOLOGIES))
+    arg_parser.add_argument("--mode", choices=["local", "tutum", "all"], default="all")
+    arg_parser.add_argument("--rounds", type=int, default=3)
+    arg_parser.add_argument("--output", help="write the results to this file instead of the standard output")
+    args = arg_parser.parse_args()
+
+    logging.getLogger("haproxy").setLevel(logging.WARNING)
+    topologies = args.topology or [parse_topology(topology) for topology in DEFAULT_TOPOLOGIES]
+    modes = ["local", "tutum"] if args.mode == "all" else [args.mode]
+
+    results = []
+    for services, containers, vhosts, ports in topologies:
+        for mode in modes:
+            results.append(bench(mode, services, containers, vhosts, ports, args.rounds))
+            sys.stderr.write("%s %dx%dx%dx%d done\n" % (mode, services, containers, vhosts, ports))
+
+    report = {"timestamp": int(time.time()),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "rounds": args.rounds,
+              "results": results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
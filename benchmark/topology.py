@@ -0,0 +1,118 @@
+import os
+import string
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haproxy"))
+
+CONTAINER_URI = "/api/v1/container/benchmark/"
+SERVICE_URI = "/api/v1/service/benchmark/"
+
+
+class TutumObject(object):
+    # Stands in for the objects returned by tutum.Utils.fetch_by_resource_uri
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+def service_name(index):
+    # service aliases must not end with digits, which would be taken for a container number: 0 => 'web-a', 26 => 'web-ba'
+    name = ""
+    while True:
+        name = string.ascii_lowercase[index % 26] + name
+        index //= 26
+        if not index:
+            return "web-%s" % name
+
+
+def service_alias(index):
+    return service_name(index).upper().replace("-", "_")
+
+
+def virtual_hosts(index, vhosts, ports=1):
+    name = service_name(index)
+    return ["http://host%d.%s.org:%d" % (k, name, 8000 + k % ports) for k in range(vhosts)]
+
+
+def link_envvars(services, containers, vhosts, ports=1):
+    # Returns the environment variables docker injects for the links of `services` services running `containers`
+    # containers each, including the environment of the linked containers
+    envvars = {}
+    for i in range(services):
+        alias = service_alias(i)
+        names = [alias] + ["%s_%d" % (alias, j) for j in range(1, containers + 1)]
+        for j, name in enumerate(names):
+            addr = "10.%d.%d.%d" % (i // 256, i % 256, max(j, 1))
+            envvars["%s_NAME" % name] = "/haproxy/%s" % name.lower()
+            envvars["%s_PORT" % name] = "tcp://%s:80" % addr
+            envvars["%s_PORT_80_TCP" % name] = "tcp://%s:80" % addr
+            envvars["%s_PORT_80_TCP_ADDR" % name] = addr
+            envvars["%s_PORT_80_TCP_PORT" % name] = "80"
+            envvars["%s_PORT_80_TCP_PROTO" % name] = "tcp"
+            envvars["%s_ENV_PATH" % name] = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+            envvars["%s_ENV_HOME" % name] = "/root"
+            if vhosts:
+                envvars["%s_ENV_VIRTUAL_HOST" % name] = ", ".join(virtual_hosts(i, vhosts, ports))
+    return envvars
+
+
+def tutum_topology(services, containers, vhosts, ports=1):
+    # Returns the HAProxy container and service objects for `services` linked services running `containers`
+    # containers each, every service serving `vhosts` virtual hosts spread over `ports` frontend ports
+    envvars = [{"key": key, "value": value} for key, value in
+               sorted(link_envvars(services, containers, vhosts, ports).iteritems())]
+    container_links = []
+    service_links = []
+    for i in range(services):
+        name = service_name(i)
+        service_links.append({"name": name, "to_service": "/api/v1/service/%s/" % name})
+        for j in range(1, containers + 1):
+            container_links.append({"name": "%s-%d" % (name, j),
+                                    "endpoints": {"80/tcp": "tcp://10.%d.%d.%d:80" % (i // 256, i % 256, j)},
+                                    "from_container": CONTAINER_URI,
+                                    "to_container": "/api/v1/container/%s-%d/" % (name, j)})
+    container = TutumObject(resource_uri=CONTAINER_URI, container_envvars=envvars,
+                            linked_to_container=container_links)
+    service = TutumObject(resource_uri=SERVICE_URI, linked_to_service=service_links)
+    return container, service
+
+
+def create_haproxy(container, service):
+    # Builds a Haproxy the way it is built in Tutum, with the API fetches answered by the given objects
+    from haproxy import Haproxy
+
+    reset_haproxy()
+    Haproxy.cls_container_uri = CONTAINER_URI
+    Haproxy.cls_service_uri = SERVICE_URI
+    Haproxy.cls_tutum_auth = "ApiKey benchmark:benchmark"
+    Haproxy.fetch_tutum_obj = classmethod(lambda cls, uri: container if uri == CONTAINER_URI else service)
+    Haproxy.fetch_tutum_objs = classmethod(lambda cls, uris: [cls.fetch_tutum_obj(uri) for uri in uris])
+    return Haproxy()
+
+
+def create_local_haproxy():
+    # Builds a Haproxy the way it is built outside of Tutum, from the current environment variables
+    from haproxy import Haproxy
+
+    reset_haproxy()
+    Haproxy.cls_container_uri = Haproxy.cls_service_uri = Haproxy.cls_tutum_auth = None
+    return Haproxy()
+
+
+def reset_haproxy():
+    # Drops the state kept between two updates, so that the next Haproxy is built from scratch
+    from haproxy import Haproxy
+
+    Haproxy.cls_specs = None
+    Haproxy.cls_cfg_digest = None
+    Haproxy.cls_cfg_dict = None
+    Haproxy.cls_maps = {}
+    Haproxy.cls_cert_store = None
+    Haproxy.cls_ca_cert_store = None
+    Haproxy.cls_haproxy_process = None
+    Haproxy.cls_reloader = None
+    Haproxy.cls_threads = None
+    Haproxy.cls_cpu_map = None
+    Haproxy.cls_sizing = None
+    Haproxy.cls_vhost_routing = None
+    Haproxy.cls_sections = {}
+    Haproxy.cls_server_slots = {}
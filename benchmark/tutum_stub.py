@@ -0,0 +1,110 @@
+# A local HTTP server answering the Tutum resource uris with the objects of a synthetic topology, to exercise the API
+# client without Tutum. Responses carry an ETag and conditional requests are answered with a 304. It can add latency
+# to every request and fail a share of them with a 503:
+#
+#   python benchmark/tutum_stub.py --port 8000 --topology 100x3x4 --latency 0.05 --failure-rate 0.2
+#
+# and then run HAProxy against it with TUTUM_REST_HOST=http://127.0.0.1:8000, TUTUM_AUTH=stub,
+# TUTUM_CONTAINER_API_URI=/api/v1/container/benchmark/ and TUTUM_SERVICE_API_URI=/api/v1/service/benchmark/
+import argparse
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from topology import tutum_topology
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, resources, latency=0, failure_rate=0):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.resources = resources
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def get_url(self):
+        return "http://%s:%d" % self.server_address
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # the response is written in several pieces, which stalls kept-alive connections on delayed acks
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        resource = self.server.resources.get(self.path)
+        if random.random() < self.server.failure_rate:
+            self.reply(503, {"error": "unavailable"})
+        elif resource is None:
+            self.reply(404, {"error": "not found"})
+        else:
+            content = json.dumps(resource)
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.reply(304, None, etag)
+            else:
+                self.reply(200, resource, etag)
+
+    def reply(self, status, body, etag=None):
+        content = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def topology_resources(services, containers, vhosts, ports=1):
+    # {resource_uri: fields} of the HAProxy container and service of the topology
+    resources = {}
+    for obj in tutum_topology(services, containers, vhosts, ports):
+        resources[obj.resource_uri] = obj.__dict__
+    return resources
+
+
+def start(resources, latency=0, failure_rate=0, port=0):
+    server = StubServer(("127.0.0.1", port), resources, latency, failure_rate)
+    worker = threading.Thread(target=server.serve_forever, name="tutum-stub")
+    worker.daemon = True
+    worker.start()
+    return server
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Serve a synthetic topology on the Tutum resource uris")
+    arg_parser.add_argument("--port", type=int, default=8000)
+    arg_parser.add_argument("--topology", default="10x2x2", help="SERVICESxCONTAINERSxVHOSTS[xPORTS]")
+    arg_parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    arg_parser.add_argument("--failure-rate", type=float, default=0, help="share of the requests failing with 503")
+    args = arg_parser.parse_args()
+
+    counts = [int(count) for count in args.topology.lower().split("x")]
+    server = StubServer(("127.0.0.1", args.port), topology_resources(*counts), args.latency, args.failure_rate)
+    print("Serving %s on %s" % (", ".join(sorted(server.resources)), server.get_url()))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# Times frontend and backend generation for growing numbers of virtual hosts. The time spent per virtual host
+# should stay flat as the count grows, a growing one means the generation is no longer linear. The virtual hosts are
+# spread over services of a few virtual hosts each, and then all served by a single service.
+import logging
+import time
+
+from topology import tutum_topology, create_haproxy
+
+VHOSTS_PER_SERVICE = 4
+PORTS = 4
+
+
+def bench(vhost_count, vhosts_per_service, rounds=3):
+    container, service = tutum_topology(vhost_count // vhosts_per_service, 1, vhosts_per_service, PORTS)
+    haproxy = create_haproxy(container, service)
+    best = None
+    for _ in range(rounds):
+        haproxy.cls_sections.clear()
+        start = time.time()
+        haproxy._config_frontend()
+        haproxy._config_backend()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    logging.getLogger("haproxy").setLevel(logging.WARNING)
+    for title, vhosts_per_service in [("%d vhosts per service" % VHOSTS_PER_SERVICE, VHOSTS_PER_SERVICE),
+                                      ("a single service", None)]:
+        print(title)
+        print("%8s %10s %12s" % ("vhosts", "seconds", "us/vhost"))
+        per_vhost = []
+        for vhost_count in [1250, 2500, 5000, 10000]:
+            elapsed = bench(vhost_count, vhosts_per_service or vhost_count)
+            per_vhost.append(elapsed / vhost_count)
+            print("%8d %10.4f %12.2f" % (vhost_count, elapsed, elapsed * 1e6 / vhost_count))
+        print("us/vhost growth from %d to %d vhosts: x%.2f" % (1250, 10000, per_vhost[-1] / per_vhost[0]))
+
+
+if __name__ == "__main__":
+    main()
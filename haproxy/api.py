@@ -0,0 +1,156 @@
+import logging
+import random
+import threading
+import time
+import urlparse
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+logger = logging.getLogger("haproxy")
+
+
+class ApiError(Exception):
+    pass
+
+
+CacheEntry = namedtuple("CacheEntry", ["fields", "etag", "expires"])
+
+
+class ApiResource(object):
+    # A fetched Tutum resource, with its fields as attributes like the objects of python-tutum
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+class ApiClient(object):
+    # Fetches Tutum resources by resource uri over a pool of kept-alive HTTP connections. A failed request is retried
+    # with a jittered exponential backoff until the `budget` seconds given to the fetch are spent, each request being
+    # limited to `timeout` seconds.
+    # Fetched resources are cached for `cache_ttl` seconds, and revalidated with their ETag once expired or
+    # invalidated.
+    def __init__(self, rest_host, headers, timeout=10, budget=60, backoff=0.5, max_backoff=10, workers=4,
+                 cache_ttl=0):
+        self.rest_host = rest_host
+        self.headers = headers
+        self.timeout = timeout
+        self.budget = budget
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._pool = None
+        self.cache_ttl = cache_ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.requests = 0
+        self.request_time = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def fetch(self, uri, budget=None):
+        with self._lock:
+            entry = self._cache.get(uri)
+            if entry and time.time() < entry.expires:
+                self.hits += 1
+                return ApiResource(entry.fields)
+
+        deadline = time.time() + (self.budget if budget is None else budget)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return ApiResource(self._get(uri, max(min(self.timeout, deadline - time.time()), 0.1), entry))
+            except ApiError as e:
+                # full jitter: a random delay up to the exponential backoff
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                if time.time() + delay >= deadline:
+                    raise ApiError("%s (gave up after %d attempts)" % (e, attempt))
+                logger.error("%s, retrying in %.1f seconds", e, delay)
+                time.sleep(delay)
+
+    def fetch_all(self, uris, budget=None):
+        # fetches the resources concurrently, returned in the order of uris
+        if len(uris) < 2:
+            return [self.fetch(uri, budget) for uri in uris]
+        return self.pool.map(lambda uri: self.fetch(uri, budget), uris)
+
+    def fetch_async(self, uri, callback, errback=None, budget=None):
+        # calls callback with the resource from a worker thread, or errback with the ApiError once the retries are
+        # exhausted, other errors are logged
+        def _fetch():
+            try:
+                resource = self.fetch(uri, budget)
+            except ApiError as e:
+                if errback:
+                    errback(e)
+                else:
+                    logger.error(e)
+                return
+            try:
+                callback(resource)
+            except Exception as e:
+                logger.exception(e)
+
+        self.pool.apply_async(_fetch)
+
+    def invalidate(self, uri):
+        # the next fetch of uri revalidates the cached resource
+        with self._lock:
+            if uri in self._cache:
+                self._cache[uri] = self._cache[uri]._replace(expires=0)
+
+    def invalidate_all(self):
+        with self._lock:
+            for uri, entry in self._cache.items():
+                self._cache[uri] = entry._replace(expires=0)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "revalidations": self.revalidations,
+                "requests": self.requests, "request_time": self.request_time}
+
+    def _get(self, uri, timeout, entry=None):
+        url = urlparse.urljoin(self.rest_host, uri)
+        headers = self.headers
+        if entry and entry.etag:
+            headers = dict(self.headers, **{"If-None-Match": entry.etag})
+        start = time.time()
+        try:
+            response = self.session.get(url, headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            raise ApiError("GET %s: %s" % (uri, e))
+        finally:
+            with self._lock:
+                self.requests += 1
+                self.request_time += time.time() - start
+
+        revalidated = response.status_code == 304 and entry
+        if revalidated:
+            fields, etag = entry.fields, entry.etag
+        elif response.status_code == 200:
+            try:
+                fields, etag = response.json(), response.headers.get("ETag")
+            except ValueError as e:
+                raise ApiError("GET %s: %s" % (uri, e))
+        else:
+            raise ApiError("GET %s: status %s" % (uri, response.status_code))
+
+        with self._lock:
+            if revalidated:
+                self.revalidations += 1
+            else:
+                self.misses += 1
+            if self.cache_ttl:
+                self._cache[uri] = CacheEntry(fields, etag, time.time() + self.cache_ttl)
+        return fields
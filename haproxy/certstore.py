@@ -0,0 +1,55 @@
+import hashlib
+import os
+import re
+from collections import OrderedDict
+
+
+class CertStore(object):
+    # The certificates of a directory, one file per certificate named after the hash of its content: a certificate is
+    # written only when it is new, and the files of the removed ones are deleted. HAProxy loads a directory in
+    # alphabetical order and serves its first certificate by default, so the first certificate is prefixed with "00-".
+    # Only the files the store writes are removed, certificates mounted in the directory are left alone: the hashed
+    # names, their temporary files, and the cert<N>.pem files of the earlier versions.
+    default_prefix = "00-"
+    owned_file_match = re.compile(r"^((00-)?[0-9a-f]{40}\.pem|\.(00-)?[0-9a-f]{40}\.pem\.tmp|cert\d+\.pem)$")
+
+    def __init__(self, directory, description):
+        self.directory = directory
+        self.description = description
+        self.certs = []
+        self.files = OrderedDict()  # file name => content
+
+    def set(self, certs):
+        # returns whether the files change, they are written by sync()
+        certs = [cert.replace("\\n", '\n') for cert in certs]
+        if certs == self.certs:
+            return False
+        files = OrderedDict()
+        for index, cert in enumerate(certs):
+            name = "%s.pem" % hashlib.sha1(cert).hexdigest()
+            files[self.default_prefix + name if index == 0 else name] = cert
+        changed = dict(files) != dict(self.files)
+        self.certs = certs
+        self.files = files
+        return changed
+
+    def get_default_file(self):
+        return next(iter(self.files), None)
+
+    def sync(self):
+        # writes the missing files through a rename, and removes the other files of the store from the directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        existing = set(os.listdir(self.directory))
+        written = []
+        for name, cert in self.files.iteritems():
+            if name not in existing:
+                tmp_file = os.path.join(self.directory, ".%s.tmp" % name)
+                with open(tmp_file, 'w') as f:
+                    f.write(cert)
+                os.rename(tmp_file, os.path.join(self.directory, name))
+                written.append(name)
+        removed = sorted(name for name in existing - set(self.files) if self.owned_file_match.match(name))
+        for name in removed:
+            os.remove(os.path.join(self.directory, name))
+        return written, removed
@@ -0,0 +1,49 @@
+import threading
+
+
+class EventFilter(object):
+    # Tells which Tutum events concern HAProxy. The watched uris are the HAProxy service and container, the linked
+    # services and their containers; an event about none of them, and whose parents are none of them, is dropped
+    # right away. The sets are rebuilt only when the links change, and are replaced at once so that the websocket
+    # thread can read them without locking.
+    transient_states = frozenset(["In progress", "Pending", "Terminating", "Starting", "Scaling", "Stopping"])
+    resource_types = frozenset(["container", "service"])
+
+    def __init__(self):
+        self.accepted = 0
+        self.filtered = 0
+        self.linked_services = frozenset()
+        self.watched = frozenset()
+        self._sources = ()
+        self._lock = threading.Lock()
+
+    def update(self, haproxy_uris, linked_services, linked_containers):
+        sources = (tuple(haproxy_uris), tuple(linked_services or []), tuple(linked_containers or []))
+        with self._lock:
+            if sources == self._sources:
+                return
+            self._sources = sources
+            self.linked_services = frozenset(sources[1])
+            self.watched = frozenset(uri for uris in sources for uri in uris if uri)
+
+    def is_watched(self, event):
+        # the fast path, dropping the events of unrelated resources
+        watched = self.watched
+        if event.get("resource_uri") in watched or any(parent in watched for parent in event.get("parents", [])):
+            return True
+        self.filtered += 1
+        return False
+
+    def is_relevant(self, event):
+        # a settled change of a container or a service of the linked services requires a reconfiguration
+        linked_services = self.linked_services
+        if event.get("state", "") not in EventFilter.transient_states and \
+                event.get("type", "").lower() in EventFilter.resource_types and \
+                any(parent in linked_services for parent in event.get("parents", [])):
+            self.accepted += 1
+            return True
+        self.filtered += 1
+        return False
+
+    def stats(self):
+        return {"accepted": self.accepted, "filtered": self.filtered}
@@ -1,15 +1,21 @@
 import os
+import hashlib
 import logging
 import subprocess
-import time
-import copy
 import re
-import thread
+import threading
+import time
 from collections import OrderedDict
 
 import tutum
 
+from api import ApiClient
+from certstore import CertStore
 from parser import Specs, parse_uuid_from_resource_uri
+from resources import detect_cpus, get_fd_limit, get_memory_limit
+from reloader import Reloader, check_haproxy_config, detect_haproxy_version
+from runtime import RuntimeApi, RuntimeApiError
+from tracing import tracer
 
 logger = logging.getLogger("haproxy")
 
@@ -18,7 +24,7 @@ class Haproxy(object):
     # envvar
     envvar_default_ssl_cert = os.getenv("DEFAULT_SSL_CERT") or os.getenv("SSL_CERT")
     envvar_default_ca_cert = os.getenv("CA_CERT")
-    envvar_maxconn = os.getenv("MAXCONN", "4096")
+    envvar_maxconn = os.getenv("MAXCONN", "4096")  # or "auto" for the memory and file descriptors of the container
     envvar_mode = os.getenv("MODE", "http")
     envvar_option = os.getenv("OPTION", "redispatch, httplog, dontlognull, forwardfor").split(",")
     envvar_rsyslog_destnation = os.getenv("RSYSLOG_DESTINATION", "127.0.0.1")
@@ -34,73 +40,145 @@ class Haproxy(object):
     envvar_http_basic_auth = os.getenv("HTTP_BASIC_AUTH")
     envvar_monitor_uri = os.getenv("MONITOR_URI")
     envvar_monitor_port = os.getenv("MONITOR_PORT")
+    envvar_runtime_updates = os.getenv("RUNTIME_UPDATES")
+    envvar_server_slots = os.getenv("SERVER_SLOTS")
+    envvar_vhost_routing = os.getenv("VHOST_ROUTING", "acl")
+    envvar_api_timeout = float(os.getenv("TUTUM_API_TIMEOUT", 10))  # seconds
+    envvar_api_budget = float(os.getenv("TUTUM_API_BUDGET", 60))  # seconds
+    envvar_api_cache_ttl = float(os.getenv("TUTUM_API_CACHE_TTL", 60))  # seconds
+    envvar_reload_min_interval = float(os.getenv("RELOAD_MIN_INTERVAL", 1))  # seconds
+    envvar_reload_max_draining = int(os.getenv("RELOAD_MAX_DRAINING", 10))
+    envvar_reload_drain_timeout = float(os.getenv("RELOAD_DRAIN_TIMEOUT", 0))  # seconds, 0 waits for the connections
+    envvar_metrics_port = os.getenv("METRICS_PORT")
+    envvar_metrics_interval = float(os.getenv("METRICS_INTERVAL", 10))  # seconds
+    envvar_server_maxconn = os.getenv("SERVER_MAXCONN")
+    envvar_server_maxqueue = os.getenv("SERVER_MAXQUEUE")
+    envvar_nbthread = os.getenv("NBTHREAD")  # a number of threads, or "auto" for the CPUs of the container
 
     # envvar overwritable
     envvar_balance = os.getenv("BALANCE", "roundrobin")
+    envvar_http_reuse = os.getenv("HTTP_REUSE", "safe")
+    envvar_keepalive = os.getenv("KEEPALIVE")  # a keep-alive timeout, or "false" to close the server connections
+    envvar_pool_max_conn = os.getenv("POOL_MAX_CONN")
 
     # const var
     const_cert_dir = "/certs/"
     const_cacert_dir = "/cacerts/"
+    const_map_dir = "/maps/"
     const_config_file = "/haproxy.cfg"
-    const_command = ['/usr/sbin/haproxy', '-f', const_config_file, '-db', '-q']
-    const_api_retry = 10  # seconds
+    const_stats_socket = "/var/run/haproxy.stats"
+    const_binary = "/usr/sbin/haproxy"
+    const_command = [const_binary, '-f', const_config_file, '-db', '-q']
+    const_api_backoff = 0.5  # seconds
+    const_api_max_backoff = 10  # seconds
+    const_empty_slot_addr = "127.0.0.1:1"
+    const_log_diff_lines = 100
+    const_write_chunk_size = 65536
+    const_max_threads = 64
+    const_bufsize = 16384
+    const_small_bufsize = 8192
+    const_session_overhead = 8192  # bytes per session besides its two buffers, roughly, SSL included
+    const_memory_share = 0.75  # of the memory of the container, the rest is left to the controller and the reloads
+    const_reserved_fds = 1000  # for the listeners, the health checks, the logs and the stats
+    const_min_maxconn = 1024
+    const_default_maxconn = 4096
 
     # class var
     cls_container_uri = os.getenv("TUTUM_CONTAINER_API_URI")
     cls_service_uri = os.getenv("TUTUM_SERVICE_API_URI")
     cls_tutum_auth = os.getenv("TUTUM_AUTH")
     cls_linked_services = None
-    cls_cfg = None
+    cls_linked_containers = None
+    cls_api = None
+    cls_specs = None
+    cls_cfg_digest = None
+    cls_cfg_dict = None
+    cls_maps = {}
     cls_haproxy_process = None
-    cls_certs = []
-
-    def __init__(self):
+    cls_haproxy_version = None
+    cls_reloader = None
+    cls_threads = None
+    cls_cpu_map = None
+    cls_sizing = None
+    cls_vhost_routing = None
+    cls_cert_store = None
+    cls_ca_cert_store = None
+    cls_server_slots = {}
+    cls_sections = {}
+
+    def __init__(self, service_uris=None):
         Haproxy.extra_bind_settings = Haproxy._parse_extra_bind_settings(Haproxy.envvar_extra_bind_settings)
         self.ssl = None
         self.ssl_updated = False
-        self.routes_added = []
+        self.cert_writer = None
+        self.routes_added = set()
         self.require_default_route = False
+        self.section_keys = set()
+        self.maps = {}
         if Haproxy.cls_container_uri and Haproxy.cls_service_uri and Haproxy.cls_tutum_auth:
-            container = self.fetch_tutum_obj(Haproxy.cls_container_uri)
-            service = self.fetch_tutum_obj(Haproxy.cls_service_uri)
+            with tracer.span("fetch"):
+                container, service = self.fetch_tutum_objs([Haproxy.cls_container_uri, Haproxy.cls_service_uri])
             Haproxy.cls_linked_services = [srv.get("to_service") for srv in service.linked_to_service]
+            Haproxy.cls_linked_containers = [link.get("to_container") for link in container.linked_to_container]
             logger.info("Current links: %s", ", ".join(
                 ["%s(%s)" % (srv.get("name"), parse_uuid_from_resource_uri(srv.get("to_service"))) for srv in
                  service.linked_to_service]))
-            self.specs = Specs(container, service)
         else:
             logger.info("Loading HAProxy definition from environment variables")
             Haproxy.cls_linked_services = None
-            Haproxy.specs = Specs()
+            Haproxy.cls_linked_containers = None
+            container = service = None
+
+        with tracer.span("specs"):
+            if Haproxy.cls_specs:
+                Haproxy.cls_specs.update(container, service, service_uris)
+            else:
+                Haproxy.cls_specs = Specs(container, service)
+        self.specs = Haproxy.cls_specs
+        logger.info("Updated services: %s", ", ".join(sorted(self.specs.dirty)) or "none")
 
     def update(self):
-        cfg_dict = OrderedDict()
-        self._config_ssl()
-        cfg_dict.update(self._config_global_defaults())
-        for cfg in self._config_tcp():
-            cfg_dict.update(cfg)
-        cfg_dict.update(self._config_frontend())
-        cfg_dict.update(self._config_backend())
-
-        cfg = self._prettify(cfg_dict)
+        good = self._snapshot()
+        with tracer.span("ssl"):
+            self._config_ssl()
+        with tracer.span("config"):
+            cfg_dict = self._config()
+
         if Haproxy.cls_service_uri and Haproxy.cls_container_uri and Haproxy.cls_tutum_auth:
-            if Haproxy.cls_cfg != cfg:
-                if not Haproxy.cls_cfg:
-                    logger.info("HAProxy configuration:\n%s" % cfg)
+            changes = self._diff_sections(Haproxy.cls_cfg_dict, cfg_dict)
+            if changes or self.maps != Haproxy.cls_maps:
+                if not Haproxy.cls_cfg_dict:
+                    logger.info("HAProxy configuration:\n%s" % self._prettify(cfg_dict))
+                elif changes:
+                    logger.info("HAProxy configuration is updated(%s):\n%s" % (
+                        changes, "\n".join(self._diff_lines(Haproxy.cls_cfg_dict, cfg_dict))))
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("HAProxy configuration:\n%s" % self._prettify(cfg_dict))
                 else:
-                    logger.info("HAProxy configuration is updated:\n%s" % cfg)
-                Haproxy.cls_cfg = cfg
-                if self._save_conf():
-                    self._run()
+                    logger.info("HAProxy host maps are updated")
+                commands = None
+                if Haproxy.envvar_runtime_updates and Haproxy.cls_haproxy_process and not self.ssl_updated:
+                    commands = self._runtime_commands(Haproxy.cls_cfg_dict, cfg_dict)
+                    map_commands = self._runtime_map_commands(Haproxy.cls_maps, self.maps)
+                    commands = None if commands is None or map_commands is None else commands + map_commands
+                Haproxy.cls_cfg_dict = cfg_dict
+                if not self._save_maps() or not self._save_conf(cfg_dict):
+                    self._rollback(good)
+                elif commands is None or not self._apply_runtime(commands):
+                    if not self._run():
+                        self._rollback(good)
             elif self.ssl_updated:
-                self._run()
+                self._wait_certs()
+                if not self._check_conf(self.const_config_file) or not self._run():
+                    self._rollback(good)
             else:
                 logger.info("HAProxy configuration remains unchanged")
             logger.info("===========END===========")
         else:
-            logger.info("HAProxy configuration:\n%s" % cfg)
-            Haproxy.cls_cfg = cfg
-            self._save_conf()
+            logger.info("HAProxy configuration:\n%s" % self._prettify(cfg_dict))
+            if not self._save_maps() or not self._save_conf(cfg_dict):
+                logger.info("===========END===========")
+                return
             logger.info("Launching HAProxy")
             p = subprocess.Popen(self.const_command)
             logger.info("HAProxy has been launched(PID: %s)", str(p.pid))
@@ -108,34 +186,193 @@ class Haproxy(object):
             p.wait()
 
     def _run(self):
-        def _wait_pid(p):
-            if p:
-                pid = p.pid
-                p.wait()
-                logger.info("HAProxy(PID:%s) has been terminated" % str(pid))
-
-        if Haproxy.cls_haproxy_process:
-            # Reload haproxy
-            logger.info("Reloading HAProxy")
-            process = subprocess.Popen(self.const_command + ["-sf", str(Haproxy.cls_haproxy_process.pid)])
-            old_process = Haproxy.cls_haproxy_process
-            thread.start_new_thread(_wait_pid, (old_process,))
-            Haproxy.cls_haproxy_process = process
-            logger.info("HAProxy has been reloaded(PID: %s)", str(Haproxy.cls_haproxy_process.pid))
-        else:
-            # Launch haproxy
-            logger.info("Launching HAProxy")
-            Haproxy.cls_haproxy_process = subprocess.Popen(self.const_command)
-            logger.info("HAProxy has been launched(PID: %s)", str(Haproxy.cls_haproxy_process.pid))
+        reloader = self.get_reloader()
+        with tracer.span("reload"):
+            succeeded = reloader.run()
+        Haproxy.cls_haproxy_process = reloader.process
+        return succeeded
+
+    @classmethod
+    def get_reloader(cls):
+        if not cls.cls_reloader:
+            socket_handoff = cls.get_haproxy_version() >= (1, 8)
+            cls.cls_reloader = Reloader(cls.const_command, cls.const_stats_socket,
+                                        min_interval=cls.envvar_reload_min_interval,
+                                        max_draining=cls.envvar_reload_max_draining,
+                                        drain_timeout=cls.envvar_reload_drain_timeout, socket_handoff=socket_handoff)
+        return cls.cls_reloader
+
+    @classmethod
+    def get_haproxy_version(cls):
+        if cls.cls_haproxy_version is None:
+            cls.cls_haproxy_version = detect_haproxy_version(cls.const_binary)
+            logger.info("HAProxy version: %s", ".".join(map(str, cls.cls_haproxy_version)) or "unknown")
+        return cls.cls_haproxy_version
+
+    @classmethod
+    def get_vhost_routing(cls):
+        # the map converter of the lookup needs HAProxy 1.6, an older one routes the virtual hosts with ACLs
+        if cls.cls_vhost_routing is None:
+            cls.cls_vhost_routing = cls.envvar_vhost_routing
+            if cls.cls_vhost_routing == "map" and cls.get_haproxy_version() < (1, 6):
+                logger.warning("VHOST_ROUTING=map needs HAProxy 1.6 or later, virtual hosts are routed with ACLs")
+                cls.cls_vhost_routing = "acl"
+        return cls.cls_vhost_routing
+
+    @classmethod
+    def get_threads(cls):
+        # The number of threads of HAProxy, and the CPUs they are pinned to. Threads need HAProxy 1.8, an older one
+        # keeps running a single process: -db turns its multi-process mode off, and the runtime API and the reloads
+        # talk to one process.
+        if cls.cls_threads is None:
+            cls.cls_threads, cls.cls_cpu_map = 1, []
+            if cls.envvar_nbthread and cls.get_haproxy_version() < (1, 8):
+                logger.warning("NBTHREAD needs HAProxy 1.8 or later, HAProxy runs a single thread")
+            elif cls.envvar_nbthread:
+                cpus, count = detect_cpus()
+                try:
+                    threads = count if cls.envvar_nbthread.lower() == "auto" else int(cls.envvar_nbthread)
+                except ValueError:
+                    logger.warning("Invalid NBTHREAD: %s, HAProxy runs a single thread", cls.envvar_nbthread)
+                    threads = 1
+                cls.cls_threads = max(1, min(threads, cls.const_max_threads))
+                # threads are pinned when each of them can have a CPU of its own, the scheduler spreads them better
+                # over a quota shared by more CPUs
+                if 1 < cls.cls_threads <= count == len(cpus):
+                    cls.cls_cpu_map = cpus[:cls.cls_threads]
+                logger.info("HAProxy threads: %d%s", cls.cls_threads,
+                            " (pinned to CPUs %s)" % ",".join(map(str, cls.cls_cpu_map)) if cls.cls_cpu_map else "")
+        return cls.cls_threads, cls.cls_cpu_map
+
+    @classmethod
+    def get_sizing(cls):
+        # The maxconn of HAProxy, and its tune.bufsize and tune.maxrewrite, None for the defaults of HAProxy. In auto
+        # mode, a session takes two file descriptors and two buffers: maxconn is what both the memory and the file
+        # descriptors of the container can hold, with smaller buffers if the regular ones leave too few connections.
+        if cls.cls_sizing is None:
+            if cls.envvar_maxconn.lower() != "auto":
+                cls.cls_sizing = (cls.envvar_maxconn, None, None)
+            else:
+                memory, fds = get_memory_limit(), get_fd_limit()
+                fd_maxconn = cls._size_fd_maxconn(fds)
+                if fd_maxconn is not None and fd_maxconn < cls.const_min_maxconn:
+                    # HAProxy raises its own limit on open files from maxconn, as far as it is allowed to
+                    logger.warning("The limit of %d open files is too low to size maxconn from, maxconn is capped to "
+                                   "%d: raise it with 'docker run --ulimit nofile'", fds, cls.const_default_maxconn)
+                    fd_maxconn = cls.const_default_maxconn
+                bufsize = cls.const_bufsize
+                maxconn = cls._size_maxconn(memory, fd_maxconn, bufsize)
+                if maxconn < cls.const_min_maxconn:
+                    bufsize = cls.const_small_bufsize
+                    maxconn = cls._size_maxconn(memory, fd_maxconn, bufsize)
+                if maxconn < cls.const_min_maxconn:
+                    logger.warning("The memory of the container holds %d connections only, maxconn is raised to %d",
+                                   maxconn, cls.const_min_maxconn)
+                    maxconn = cls.const_min_maxconn
+                cls.cls_sizing = (str(maxconn), bufsize, bufsize // 16)
+                logger.info("HAProxy maxconn: %d, bufsize: %d (memory: %s MB, file descriptors: %s)", maxconn, bufsize,
+                            memory // (1024 * 1024) if memory else "unknown", fds or "unlimited")
+        return cls.cls_sizing
+
+    @classmethod
+    def _size_fd_maxconn(cls, fds):
+        # a quarter of the file descriptors at most is kept for the listeners, the health checks, the logs and the stats
+        if not fds:
+            return None
+        return (fds - min(cls.const_reserved_fds, fds // 4)) // 2
+
+    @classmethod
+    def _size_maxconn(cls, memory, fd_maxconn, bufsize):
+        limits = []
+        if memory:
+            limits.append(int(memory * cls.const_memory_share) // (2 * bufsize + cls.const_session_overhead))
+        if fd_maxconn:
+            limits.append(fd_maxconn)
+        if not limits:
+            return cls.const_default_maxconn
+        return min(limits)
+
+    @classmethod
+    def _bind_lines(cls, bind):
+        # ':80 ssl crt /certs/' => a listener per thread, each with a socket of its own which the kernel balances the
+        # connections over, instead of the threads taking turns on a single one
+        threads = cls.get_threads()[0]
+        if threads == 1:
+            return ["bind %s" % bind]
+        return ["bind %s process 1/%d" % (bind.strip(), thread) for thread in range(1, threads + 1)]
+
+    def _config(self):
+        cfg_dict = OrderedDict()
+        with tracer.span("global"):
+            cfg_dict.update(self._cached("global", (), self._config_global_defaults))
+        with tracer.span("tcp"):
+            for cfg in self._config_tcp():
+                cfg_dict.update(cfg)
+        with tracer.span("frontend"):
+            cfg_dict.update(self._config_frontend())
+        with tracer.span("backend"):
+            cfg_dict.update(self._config_backend())
+
+        for key in set(Haproxy.cls_sections.iterkeys()) - self.section_keys:
+            del Haproxy.cls_sections[key]
+        return cfg_dict
+
+    @staticmethod
+    def _diff_sections(old_cfg, new_cfg):
+        # 'added: backend SERVICE_B, changed: frontend port_80, backend SERVICE_A'
+        old_cfg = old_cfg or OrderedDict()
+        added = [section for section in new_cfg if section not in old_cfg]
+        removed = [section for section in old_cfg if section not in new_cfg]
+        changed = [section for section, lines in new_cfg.iteritems()
+                   if section in old_cfg and old_cfg[section] is not lines and old_cfg[section] != lines]
+
+        changes = []
+        for name, sections in [("added", added), ("removed", removed), ("changed", changed)]:
+            if sections:
+                changes.append("%s: %s" % (name, ", ".join(sections)))
+        if not changes and old_cfg.keys() != new_cfg.keys():
+            changes.append("reordered")
+        return ", ".join(changes)
+
+    @staticmethod
+    def _diff_lines(old_cfg, new_cfg):
+        # the lines added to and removed from each section, at most const_log_diff_lines of them:
+        # ['backend SERVICE_A', '  - server A_1 10.7.0.3:80 check', '  + server A_1 10.7.0.4:80 check']
+        lines = []
+        for section, contents in new_cfg.iteritems():
+            old_contents = old_cfg.get(section)
+            if old_contents is None:
+                lines.append("%s (added)" % section)
+                lines.extend("  + %s" % content for content in contents)
+            elif old_contents is not contents and old_contents != contents:
+                old_set, new_set = set(old_contents), set(contents)
+                lines.append(section)
+                lines.extend("  - %s" % content for content in old_contents if content not in new_set)
+                lines.extend("  + %s" % content for content in contents if content not in old_set)
+        lines.extend("%s (removed)" % section for section in old_cfg if section not in new_cfg)
+        if len(lines) > Haproxy.const_log_diff_lines:
+            lines[Haproxy.const_log_diff_lines:] = ["... %d more lines" % (len(lines) - Haproxy.const_log_diff_lines)]
+        return lines
+
+    @staticmethod
+    def _render(cfg):
+        # the text of the configuration, in chunks of whole sections of about const_write_chunk_size
+        chunk = []
+        size = 0
+        for section, contents in cfg.iteritems():
+            text = "%s\n  %s\n" % (section, "\n  ".join(contents)) if contents else "%s\n" % section
+            chunk.append(text)
+            size += len(text)
+            if size >= Haproxy.const_write_chunk_size:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk)
 
     @staticmethod
     def _prettify(cfg):
-        text = ""
-        for section, contents in cfg.items():
-            text += "%s\n" % section
-            for content in contents:
-                text += "  %s\n" % content
-        return text.strip()
+        return "".join(Haproxy._render(cfg)).strip()
 
     def _config_ssl(self):
         certs = []
@@ -146,73 +383,241 @@ class Haproxy(object):
             cacerts.append(self.envvar_default_ca_cert)
         certs.extend(self.specs.get_default_ssl_cert())
         certs.extend(self.specs.get_ssl_cert())
+        cert_store, ca_cert_store = self.get_cert_stores()
+        updated_stores = [store for store, store_certs in [(cert_store, certs), (ca_cert_store, cacerts)]
+                          if store.set(store_certs)]
         if certs:
-            if set(certs) != set(Haproxy.cls_certs):
-                Haproxy.cls_certs = copy.copy(certs)
-                self.ssl_updated = True
-                self._save_certs(certs)
             self.ssl = "ssl crt /certs/"
         if cacerts:
-            if set(cacerts) != set(Haproxy.cls_certs):
-                Haproxy.cls_certs = copy.copy(cacerts)
-                self.ssl_updated = True
-                self._save_ca_certs(cacerts)
-            self.ssl += " ca-file /cacerts/cert0.pem verify required"
+            self.ssl += " ca-file /cacerts/%s verify required" % ca_cert_store.get_default_file()
+        if updated_stores:
+            self.ssl_updated = True
+            # the certificates are written while the configuration is generated, and waited for before validating it
+            self.cert_writer = threading.Thread(target=self._save_certs, args=(updated_stores,), name="cert-writer")
+            self.cert_writer.start()
 
-    def _save_certs(self, certs):
-        try:
-            if not os.path.exists(self.const_cert_dir):
-                os.makedirs(self.const_cert_dir)
-        except Exception as e:
-            logger.error(e)
-        for index, cert in enumerate(certs):
-            cert_filename = "%scert%d.pem" % (self.const_cert_dir, index)
+    @classmethod
+    def get_cert_stores(cls):
+        if not cls.cls_cert_store:
+            cls.cls_cert_store = CertStore(cls.const_cert_dir, "SSL certificates")
+            cls.cls_ca_cert_store = CertStore(cls.const_cacert_dir, "CA certificates")
+        return cls.cls_cert_store, cls.cls_ca_cert_store
+
+    def _wait_certs(self):
+        if self.cert_writer:
+            with tracer.span("certs"):
+                self.cert_writer.join()
+            self.cert_writer = None
+
+    @staticmethod
+    def _save_certs(stores):
+        for store in stores:
             try:
-                with open(cert_filename, 'w') as f:
-                    f.write(cert.replace("\\n", '\n'))
+                written, removed = store.sync()
+                logger.info("%s are updated(%d written, %d removed)", store.description, len(written), len(removed))
             except Exception as e:
                 logger.error(e)
-        logger.info("SSL certificates are updated")
 
-    def _save_ca_certs(self, certs):
+    def _apply_runtime(self, commands):
+        if not commands:
+            logger.info("HAProxy runtime state remains unchanged")
+            return True
+        runtime = RuntimeApi(self.const_stats_socket)
         try:
-            if not os.path.exists(self.const_cacert_dir):
-                os.makedirs(self.const_cacert_dir)
+            with tracer.span("runtime"):
+                for command in commands:
+                    runtime.apply(command)
+        except RuntimeApiError as e:
+            logger.error("Failed to update HAProxy through the runtime API, falling back to reload: %s" % e)
+            return False
+        logger.info("HAProxy is updated through the runtime API")
+        return True
+
+    @staticmethod
+    def _parse_servers(lines):
+        # split the lines of a section into its server slots and the rest:
+        # 'server WEB_1 10.7.0.3:80 weight 10 check' =>
+        #   {'WEB_1': {'addr': '10.7.0.3', 'port': '80', 'weight': '10', 'disabled': False, 'options': ['check']}}
+        servers = OrderedDict()
+        others = []
+        for line in lines:
+            terms = line.split()
+            if len(terms) < 3 or terms[0] != "server":
+                others.append(line)
+                continue
+            addr, _, port = terms[2].rpartition(":")
+            server = {"addr": addr, "port": port, "weight": None, "disabled": False, "options": []}
+            options = iter(terms[3:])
+            for option in options:
+                if option == "weight":
+                    server["weight"] = next(options, None)
+                elif option == "disabled":
+                    server["disabled"] = True
+                else:
+                    server["options"].append(option)
+            servers[terms[1]] = server
+        return servers, others
+
+    @staticmethod
+    def _runtime_commands(old_cfg, new_cfg):
+        # Returns the runtime API commands turning old_cfg into new_cfg, or None if a reload is required.
+        # Servers can be re-addressed, re-weighted, enabled or disabled at runtime, everything else is structural.
+        if not old_cfg or old_cfg.keys() != new_cfg.keys():
+            return None
+
+        commands = []
+        for section, lines in new_cfg.iteritems():
+            if old_cfg[section] == lines:
+                continue
+            old_servers, old_others = Haproxy._parse_servers(old_cfg[section])
+            new_servers, new_others = Haproxy._parse_servers(lines)
+            if old_others != new_others or not section.startswith(("backend ", "listen ")):
+                return None
+
+            proxy = section.split(" ", 1)[1]
+            for name, server in new_servers.iteritems():
+                old_server = old_servers.get(name)
+                if not old_server or old_server["options"] != server["options"]:
+                    return None
+                # take a server out of rotation before touching it, and put it back only once it is updated
+                if server["disabled"] and not old_server["disabled"]:
+                    commands.append("disable server %s/%s" % (proxy, name))
+                if (old_server["addr"], old_server["port"]) != (server["addr"], server["port"]):
+                    if Haproxy.get_haproxy_version() < (1, 8):
+                        # the address of a server cannot be changed at runtime before HAProxy 1.8
+                        return None
+                    commands.append("set server %s/%s addr %s port %s" % (proxy, name, server["addr"], server["port"]))
+                if old_server["weight"] != server["weight"]:
+                    commands.append("set weight %s/%s %s" % (proxy, name, server["weight"] or "1"))
+                if old_server["disabled"] and not server["disabled"]:
+                    commands.append("enable server %s/%s" % (proxy, name))
+            for name, old_server in old_servers.iteritems():
+                if name not in new_servers and not old_server["disabled"]:
+                    commands.append("disable server %s/%s" % (proxy, name))
+        return commands
+
+    @staticmethod
+    def _runtime_map_commands(old_maps, new_maps):
+        # Returns the runtime API commands turning the entries of old_maps into new_maps, or None if a reload is
+        # required to load or drop a map file
+        if set(old_maps.iterkeys()) != set(new_maps.iterkeys()):
+            return None
+
+        commands = []
+        for map_file, entries in new_maps.iteritems():
+            old_entries = old_maps[map_file]
+            for key, value in entries.iteritems():
+                if key not in old_entries:
+                    commands.append("add map %s %s %s" % (map_file, key, value))
+                elif old_entries[key] != value:
+                    commands.append("set map %s %s %s" % (map_file, key, value))
+            for key in old_entries:
+                if key not in entries:
+                    commands.append("del map %s %s" % (map_file, key))
+        return commands
+
+    def _save_maps(self):
+        try:
+            if self.maps and not os.path.exists(self.const_map_dir):
+                os.makedirs(self.const_map_dir)
+            with tracer.span("maps"):
+                for map_file, entries in self.maps.iteritems():
+                    if entries != Haproxy.cls_maps.get(map_file):
+                        with open(map_file, 'w') as f:
+                            for key, value in entries.iteritems():
+                                f.write("%s %s\n" % (key, value))
+            Haproxy.cls_maps = self.maps
+            return True
         except Exception as e:
             logger.error(e)
-        for index, cert in enumerate(certs):
-            cert_filename = "%scert%d.pem" % (self.const_cacert_dir, index)
-            try:
-                with open(cert_filename, 'w') as f:
-                    f.write(cert.replace("\\n", '\n'))
-            except Exception as e:
-                logger.error(e)
-        logger.info("CA certificates are updated")
+            return False
 
-    def _save_conf(self):
+    def _save_conf(self, cfg_dict, check=True):
+        # The configuration is streamed to a staging file, and moved in place once HAProxy has validated it. The
+        # digest of the file identifies the configuration in the logs.
+        staging_file = self.const_config_file + ".new"
+        digest = hashlib.md5()
         try:
-            with open(self.const_config_file, 'w') as f:
-                f.write(Haproxy.cls_cfg)
+            with tracer.span("write"), open(staging_file, 'w') as f:
+                for chunk in self._render(cfg_dict):
+                    f.write(chunk)
+                    digest.update(chunk)
+            if check:
+                self._wait_certs()
+                if not self._check_conf(staging_file):
+                    return False
+            os.rename(staging_file, self.const_config_file)
+            if digest.hexdigest() != Haproxy.cls_cfg_digest:
+                Haproxy.cls_cfg_digest = digest.hexdigest()
+                logger.info("HAProxy configuration is saved(md5: %s)", Haproxy.cls_cfg_digest)
             return True
         except Exception as e:
             logger.error(e)
             return False
 
+    def _check_conf(self, config_file):
+        with tracer.span("check") as span:
+            errors = check_haproxy_config(self.const_binary, config_file)
+        elapsed = (time.time() - span.start) * 1000
+        if errors:
+            logger.error("HAProxy configuration is invalid(checked in %d ms):\n%s", elapsed, errors)
+            return False
+        logger.info("HAProxy configuration is valid(checked in %d ms)", elapsed)
+        return True
+
+    def _snapshot(self):
+        cert_store, ca_cert_store = self.get_cert_stores()
+        return Haproxy.cls_cfg_dict, Haproxy.cls_maps, cert_store.certs, ca_cert_store.certs
+
+    def _rollback(self, good):
+        # Goes back to the last known good configuration and certificates: the next update is compared against them,
+        # and the next reload loads them
+        cfg_dict, maps, certs, cacerts = good
+        logger.error("Rolling back to the last known good HAProxy configuration")
+        Haproxy.cls_cfg_dict = cfg_dict
+        self.maps = maps
+        self._save_maps()
+        if cfg_dict:
+            self._save_conf(cfg_dict, check=False)
+        if self.ssl_updated:
+            self._wait_certs()
+            cert_store, ca_cert_store = self.get_cert_stores()
+            self._save_certs([store for store, store_certs in [(cert_store, certs), (ca_cert_store, cacerts)]
+                              if store.set(store_certs)])
+
     @classmethod
     def _config_global_defaults(cls):
+        maxconn, bufsize, maxrewrite = cls.get_sizing()
         cfg = OrderedDict()
         cfg["global"] = ["log %s local0" % cls.envvar_rsyslog_destnation,
                          "log %s local1 notice" % cls.envvar_rsyslog_destnation,
                          "log-send-hostname",
-                         "maxconn %s" % cls.envvar_maxconn,
+                         "maxconn %s" % maxconn,
                          "pidfile /var/run/haproxy.pid",
                          "user haproxy",
                          "group haproxy",
                          "daemon",
-                         "stats socket /var/run/haproxy.stats level admin"]
+                         "stats socket %s level admin" % cls.const_stats_socket]
+        if cls.get_haproxy_version() >= (1, 8):
+            # lets a reloading process take the listening sockets over
+            cfg["global"][-1] += " expose-fd listeners"
+        if bufsize:
+            cfg["global"].append("tune.bufsize %d" % bufsize)
+            cfg["global"].append("tune.maxrewrite %d" % maxrewrite)
+        threads, cpu_map = cls.get_threads()
+        if threads > 1:
+            cfg["global"].append("nbthread %d" % threads)
+            for thread, cpu in enumerate(cpu_map, 1):
+                cfg["global"].append("cpu-map 1/%d %d" % (thread, cpu))
+        if cls.envvar_metrics_port:
+            # keeps the connection of the metrics exporter open between two polls
+            cfg["global"].append("stats timeout %ds" % (cls.envvar_metrics_interval + 10))
         cfg["defaults"] = ["balance %s" % cls.envvar_balance,
                            "log global",
                            "mode %s" % cls.envvar_mode]
+        if bufsize:
+            # the frontends would otherwise stop at the 2000 connections of HAProxy
+            cfg["defaults"].append("maxconn %s" % maxconn)
 
         bind = " ".join([cls.envvar_stats_port, cls.extra_bind_settings.get(cls.envvar_stats_port, "")])
         cfg["listen stats"] = ["bind :%s" % bind.strip(),
@@ -265,6 +670,16 @@ class Haproxy(object):
                 cfg["userlist haproxy_userlist"] = userlist
         return cfg
 
+    def _cached(self, key, inputs, render):
+        # Returns what render() returned the last time it was called with the same inputs under the same key
+        self.section_keys.add(key)
+        cached = Haproxy.cls_sections.get(key)
+        if cached and cached[0] == inputs:
+            return cached[1]
+        result = render()
+        Haproxy.cls_sections[key] = (inputs, result)
+        return result
+
     def _config_tcp(self):
         cfgs = []
         if not self._get_service_attr("tcp_ports"):
@@ -277,148 +692,89 @@ class Haproxy(object):
                 ports.extend(tcp_ports)
 
         for port in set(ports):
-            cfg = OrderedDict()
-
-            ssl = False
-            port_num = port
-            if port.lower().endswith("/ssl"):
-                port_num = port[:-4]
-                if self.ssl:
-                    ssl = True
-
-            bind = " ".join([port_num, self.extra_bind_settings.get(port_num, "")])
-            if ssl:
-                bind = " ".join([bind.strip(), self.ssl])
-
-            listen = ["bind :%s" % bind.strip(), "mode tcp"]
-
-            for _service_alias, routes in self.specs.get_routes().iteritems():
-                tcp_ports = self._get_service_attr("tcp_ports", _service_alias)
-                if tcp_ports and port in tcp_ports:
-                    for route in routes:
-                        if route["port"] == port_num:
-                            tcp_route = ["server %s %s:%s" % (route["container_name"], route["addr"], route["port"])]
-
-                            health_check = self._get_service_attr("health_check", _service_alias)
-                            health_check = health_check if health_check else Haproxy.envvar_health_check
-                            tcp_route.append(health_check)
-
-                            listen.append(" ".join(tcp_route))
-                            self.routes_added.append(route)
-
-            options = self._get_service_attr('option', service_alias)
-            if options:
-                for option in options:
-                    listen.append("option %s" % option)
-
-            extra_settings = self._get_service_attr('extra_settings', service_alias)
-            if extra_settings:
-                settings = re.split(r'(?<!\\),', extra_settings)
-                for setting in settings:
-                    if setting.strip():
-                        listen.append(setting.strip().replace("\,", ","))
-
-            cfg["listen port_%s" % port_num] = listen
+            service_aliases = [_service_alias for _service_alias in self.specs.get_routes().iterkeys()
+                               if port in (self._get_service_attr("tcp_ports", _service_alias) or [])]
+            revisions = [self.specs.get_revision(_service_alias) for _service_alias in service_aliases]
+            inputs = (self.ssl, service_alias, self.specs.get_revision(service_alias), service_aliases, revisions)
+            cfg, routes = self._cached("listen port_%s" % port, inputs,
+                                       lambda: self._config_tcp_port(port, service_alias))
+            self.routes_added.update(routes)
             cfgs.append(cfg)
 
         return cfgs
 
-    def _config_frontend(self):
-        monitor_uri_configured = False
+    def _config_tcp_port(self, port, service_alias):
         cfg = OrderedDict()
-        if self.specs.get_vhosts():
-            frontends_dict = {}
-            rule_counter = 0
-            for vhost in self.specs.get_vhosts():
-                rule_counter += 1
-                port = vhost["port"]
-
-                # initialize bind clause for each port
-                if port not in frontends_dict:
-                    ssl = False
-                    for v in self.specs.get_vhosts():
-                        if v["port"] == port:
-                            scheme = v["scheme"].lower()
-                            if scheme in ["https", "wss"] and self.ssl:
-                                ssl = True
-                                break
-
-                    bind = " ".join([port, self.extra_bind_settings.get(port, "")])
-                    if ssl:
-                        bind = " ".join([bind.strip(), self.ssl])
-
-                    frontends_dict[port] = ["bind :%s" % bind]
-                    if ssl:
-                        frontends_dict[port].append("reqadd X-Forwarded-Proto:\ https")
-
-                    # add websocket acl rule
-                    frontends_dict[port].append("acl is_websocket hdr(Upgrade) -i WebSocket")
-
-                    # add monitor uri
-                    if port == Haproxy.envvar_monitor_port and Haproxy.envvar_monitor_uri:
-                        frontends_dict[port].append("monitor-uri %s" % Haproxy.envvar_monitor_uri)
-                        monitor_uri_configured = True
-
-                acl_rule = []
-                # calculate virtual host rule
-                host_rules = []
-                host = vhost["host"].strip("/")
-                if host == "*":
-                    pass
-                elif "*" in host:
-                    host_rules.append("acl host_rule_%d hdr_reg(host) -i ^%s$" % (
-                        rule_counter, host.replace(".", "\.").replace("*", ".*")))
-                    host_rules.append("acl host_rule_%d_port hdr_reg(host) -i ^%s:%s$" % (
-                        rule_counter, host.replace(".", "\.").replace("*", ".*"), port))
-                elif host:
-                    host_rules.append("acl host_rule_%d hdr(host) -i %s" % (rule_counter, host))
-                    host_rules.append("acl host_rule_%d_port hdr(host) -i %s:%s" % (rule_counter, host, port))
-                acl_rule.extend(host_rules)
-
-                # calculate virtual path rules
-                path_rules = []
-                path = vhost["path"].strip()
-                if "*" in path:
-                    path_rules.append(
-                        "acl path_rule_%d path_reg -i ^%s$" % (
-                            rule_counter, path.replace(".", "\.").replace("*", ".*")))
-                elif path:
-                    path_rules.append("acl path_rule_%d path -i %s" % (rule_counter, path))
-                acl_rule.extend(path_rules)
-
-                if vhost["scheme"].lower() in ["ws", "wss"]:
-                    acl_condition = "is_websocket"
-                else:
-                    acl_condition = ""
+        routes_added = set()
 
-                if path_rules:
-                    acl_condition = " ".join([acl_condition, "path_rule_%d" % rule_counter])
+        ssl = False
+        port_num = port
+        if port.lower().endswith("/ssl"):
+            port_num = port[:-4]
+            if self.ssl:
+                ssl = True
 
-                if host_rules:
-                    acl_condition_1 = ("%s host_rule_%d" % (acl_condition, rule_counter)).strip()
-                    acl_condition_2 = ("%s host_rule_%d_port" % (acl_condition, rule_counter)).strip()
-                    acl_condition = " or ".join([acl_condition_1, acl_condition_2])
+        bind = " ".join([port_num, self.extra_bind_settings.get(port_num, "")])
+        if ssl:
+            bind = " ".join([bind.strip(), self.ssl])
 
-                if acl_condition:
-                    use_backend = "use_backend SERVICE_%s if %s" % (vhost["service_alias"], acl_condition)
-                    acl_rule.append(use_backend)
-                    frontends_dict[port].extend(acl_rule)
+        listen = self._bind_lines(":%s" % bind.strip()) + ["mode tcp"]
+
+        for _service_alias, routes in self.specs.get_routes().iteritems():
+            tcp_ports = self._get_service_attr("tcp_ports", _service_alias)
+            if tcp_ports and port in tcp_ports:
+                for route in routes:
+                    if route.port == port_num:
+                        tcp_route = ["server %s %s:%s" % (route.container_name, route.addr, route.port)]
+
+                        health_check = self._get_service_attr("health_check", _service_alias)
+                        health_check = health_check if health_check else Haproxy.envvar_health_check
+                        tcp_route.append(health_check)
+                        tcp_route.extend(self._get_server_limits(_service_alias))
+
+                        listen.append(" ".join(tcp_route))
+                        routes_added.add(route)
+
+        options = self._get_service_attr('option', service_alias)
+        if options:
+            for option in options:
+                listen.append("option %s" % option)
+
+        extra_settings = self._get_service_attr('extra_settings', service_alias)
+        if extra_settings:
+            settings = re.split(r'(?<!\\),', extra_settings)
+            for setting in settings:
+                if setting.strip():
+                    listen.append(setting.strip().replace("\,", ","))
+
+        cfg["listen port_%s" % port_num] = listen
+        return cfg, routes_added
 
-            for port, frontend in frontends_dict.iteritems():
+    def _config_frontend(self):
+        monitor_uri_configured = False
+        cfg = OrderedDict()
+        if self.specs.get_vhosts():
+            for port, vhosts in self.specs.get_vhosts_by_port().iteritems():
+                revisions = [(vhost.service_alias, self.specs.get_revision(vhost.service_alias)) for vhost in vhosts]
+                frontend, map_entries = self._cached("frontend port_%s" % port, (self.ssl, revisions),
+                                                     lambda: self._config_frontend_port(port, vhosts))
                 cfg["frontend port_%s" % port] = frontend
+                if map_entries:
+                    self.maps[self._get_map_file(port)] = map_entries
+                if port == Haproxy.envvar_monitor_port and Haproxy.envvar_monitor_uri:
+                    monitor_uri_configured = True
 
         else:
-            all_routes = []
             for routes in self.specs.get_routes().itervalues():
-                all_routes.extend(routes)
-            if len(self.routes_added) < len(all_routes):
-                self.require_default_route = True
+                if any(route not in self.routes_added for route in routes):
+                    self.require_default_route = True
+                    break
 
             if self.require_default_route:
-                frontend = [("bind :80 %s" % self.extra_bind_settings.get('80', "")).strip()]
+                frontend = self._bind_lines((":80 %s" % self.extra_bind_settings.get('80', "")).strip())
                 if self.ssl and self:
-                    frontend.append(
-                        ("bind :443 %s %s" % (self.ssl, self.extra_bind_settings.get('443', ""))).strip())
+                    frontend.extend(
+                        self._bind_lines((":443 %s %s" % (self.ssl, self.extra_bind_settings.get('443', ""))).strip()))
                     frontend.append("reqadd X-Forwarded-Proto:\ https")
 
                 if Haproxy.envvar_monitor_uri and (
@@ -426,7 +782,7 @@ class Haproxy(object):
                     frontend.append("monitor-uri %s" % Haproxy.envvar_monitor_uri)
                     monitor_uri_configured = True
                     
-                frontend.append("maxconn %s" %  Haproxy.envvar_maxconn)
+                frontend.append("maxconn %s" %  Haproxy.get_sizing()[0])
                 frontend.append("default_backend default_service")
                 cfg["frontend default_frontend"] = frontend
 
@@ -436,6 +792,193 @@ class Haproxy(object):
 
         return cfg
 
+    def _config_frontend_port(self, port, vhosts):
+        ssl = False
+        for v in vhosts:
+            if v.is_ssl and self.ssl:
+                ssl = True
+                break
+
+        bind = " ".join([port, self.extra_bind_settings.get(port, "")])
+        if ssl:
+            bind = " ".join([bind.strip(), self.ssl])
+
+        frontend = self._bind_lines(":%s" % bind)
+        if ssl:
+            frontend.append("reqadd X-Forwarded-Proto:\ https")
+
+        # add websocket acl rule
+        frontend.append("acl is_websocket hdr(Upgrade) -i WebSocket")
+
+        # add monitor uri
+        if port == Haproxy.envvar_monitor_port and Haproxy.envvar_monitor_uri:
+            frontend.append("monitor-uri %s" % Haproxy.envvar_monitor_uri)
+
+        # In map routing mode, exact hosts are looked up in a map file instead of being matched one by one. The
+        # lookup takes the place of the first of them, and a later one only joins the map if no rule emitted since
+        # the lookup can match the same host, which keeps the precedence of the rules.
+        map_entries = OrderedDict()
+        map_file = self._get_map_file(port)
+        shadowed_hosts = set()
+        all_hosts_shadowed = False
+
+        map_position = None
+        rules = []
+        for vhost in vhosts:
+            host = vhost.host
+            if self.get_vhost_routing() == "map" and self._is_exact_host_vhost(vhost):
+                if map_position is None:
+                    map_position = len(rules)
+                if host.lower() in map_entries:
+                    continue
+                if not all_hosts_shadowed and host.lower() not in shadowed_hosts:
+                    map_entries[host.lower()] = "SERVICE_%s" % vhost.service_alias
+                    map_entries["%s:%s" % (host.lower(), port)] = "SERVICE_%s" % vhost.service_alias
+                    continue
+            if map_position is not None:
+                if not host or "*" in host:
+                    all_hosts_shadowed = True
+                shadowed_hosts.add(host.lower())
+            rules.append(vhost)
+
+        # Vhosts are sorted by weight, and the order of the rules only matters between different weights. Within a
+        # weight tier the rules are grouped per backend and compiled into as few acls as possible. A tier never
+        # spans the map lookup.
+        tiers = []
+        previous_weight = None
+        for index, vhost in enumerate(rules):
+            weight = self._get_service_attr("virtual_host_weight", vhost.service_alias)
+            if not tiers or weight != previous_weight or index == map_position:
+                tiers.append((index, []))
+            tiers[-1][1].append(vhost)
+            previous_weight = weight
+
+        map_lookup = "use_backend %%[req.hdr(host),lower,map(%s)] if { req.hdr(host),lower,map(%s) -m found }" % (
+            map_file, map_file)
+        rule_counter = 0
+        for index, tier in tiers:
+            if index == map_position:
+                frontend.append(map_lookup)
+            for service_alias, websocket, hosts, paths in self._group_vhosts(tier):
+                rule_counter += 1
+                acl_condition = []
+                if websocket:
+                    acl_condition.append("is_websocket")
+
+                path_rules = self._compile_path_rules(paths)
+                for path_rule in path_rules:
+                    frontend.append("acl path_rule_%d %s" % (rule_counter, path_rule))
+                if path_rules:
+                    acl_condition.append("path_rule_%d" % rule_counter)
+
+                host_rules = self._compile_host_rules(hosts, port)
+                for host_rule in host_rules:
+                    frontend.append("acl host_rule_%d %s" % (rule_counter, host_rule))
+                if host_rules:
+                    acl_condition.append("host_rule_%d" % rule_counter)
+
+                if acl_condition:
+                    frontend.append("use_backend SERVICE_%s if %s" % (service_alias, " ".join(acl_condition)))
+        if map_position is not None and map_position == len(rules):
+            frontend.append(map_lookup)
+
+        return frontend, map_entries
+
+    @staticmethod
+    def _group_vhosts(vhosts):
+        # Merges the hosts of the vhosts sharing a backend and a path, then the paths of the groups sharing a
+        # backend and the same hosts: [(service_alias, websocket, hosts, paths)]
+        # the lists keep the order of the hosts and paths, the sets next to them make the lookups constant time
+        by_path = OrderedDict()
+        for vhost in vhosts:
+            key = (vhost.service_alias, vhost.is_websocket, vhost.path)
+            hosts, seen_hosts = by_path.setdefault(key, ([], set()))
+            host = vhost.host.lower()
+            if host not in seen_hosts:
+                hosts.append(host)
+                seen_hosts.add(host)
+
+        by_hosts = OrderedDict()
+        for (service_alias, websocket, path), (hosts, seen_hosts) in by_path.iteritems():
+            if "" in seen_hosts or "*" in seen_hosts:
+                hosts, seen_hosts = [], frozenset()
+            key = (service_alias, websocket, frozenset(seen_hosts))
+            paths, seen_paths = by_hosts.setdefault(key, (hosts, [], set()))[1:]
+            if path not in seen_paths:
+                paths.append(path)
+                seen_paths.add(path)
+
+        return [(service_alias, websocket, group_hosts, group_paths)
+                for (service_alias, websocket, _), (group_hosts, group_paths, _) in by_hosts.iteritems()]
+
+    @staticmethod
+    def _compile_host_rules(hosts, port):
+        # ["a.com", "*.b.com", "c.*", "d*.com"] on port 80 =>
+        #   ["hdr(host) -i a.com a.com:80", "hdr_end(host) -i .b.com .b.com:80", "hdr_beg(host) -i c.",
+        #    "hdr_reg(host) -i ^(d.*\.com)(:80)?$"]
+        # an empty list of hosts matches any host
+        exact, suffixes, prefixes, regexes = [], [], [], []
+        for host in hosts:
+            wildcards = host.count("*")
+            if not wildcards:
+                exact.extend([host, "%s:%s" % (host, port)])
+            elif wildcards == 1 and host.startswith("*"):
+                suffixes.extend([host[1:], "%s:%s" % (host[1:], port)])
+            elif wildcards == 1 and host.endswith("*"):
+                prefixes.append(host[:-1])
+            else:
+                regexes.append(host.replace(".", "\.").replace("*", ".*"))
+
+        rules = []
+        if exact:
+            rules.append("hdr(host) -i %s" % " ".join(exact))
+        if suffixes:
+            rules.append("hdr_end(host) -i %s" % " ".join(suffixes))
+        if prefixes:
+            rules.append("hdr_beg(host) -i %s" % " ".join(prefixes))
+        if regexes:
+            rules.append("hdr_reg(host) -i ^(%s)(:%s)?$" % ("|".join(regexes), port))
+        return rules
+
+    @staticmethod
+    def _compile_path_rules(paths):
+        # ["/a", "/b/*", "/*.js", "/*/c/*"] =>
+        #   ["path -i /a", "path_beg -i /b/", "path_end -i .js", "path_reg -i ^(/.*/c/.*)$"]
+        # an empty path matches any path
+        if "" in paths:
+            return []
+
+        exact, prefixes, suffixes, regexes = [], [], [], []
+        for path in paths:
+            wildcards = path.count("*")
+            if not wildcards:
+                exact.append(path)
+            elif wildcards == 1 and path.endswith("*"):
+                prefixes.append(path[:-1])
+            elif wildcards == 1 and path.startswith("/*") and not path.startswith("/*/"):
+                suffixes.append(path[2:])
+            else:
+                regexes.append(path.replace(".", "\.").replace("*", ".*"))
+
+        rules = []
+        if exact:
+            rules.append("path -i %s" % " ".join(exact))
+        if prefixes:
+            rules.append("path_beg -i %s" % " ".join(prefixes))
+        if suffixes:
+            rules.append("path_end -i %s" % " ".join(suffixes))
+        if regexes:
+            rules.append("path_reg -i ^(%s)$" % "|".join(regexes))
+        return rules
+
+    @staticmethod
+    def _is_exact_host_vhost(vhost):
+        return vhost.host and "*" not in vhost.host and not vhost.path and not vhost.is_websocket
+
+    @classmethod
+    def _get_map_file(cls, port):
+        return "%sport_%s.map" % (cls.const_map_dir, port)
+
     def _config_backend(self):
         cfg = OrderedDict()
 
@@ -445,120 +988,231 @@ class Haproxy(object):
             services_aliases = self.specs.get_service_aliases()
 
         for service_alias in services_aliases:
-            backend = []
-            is_sticky = False
-
-            # Add http-service-close option for websocket backend
-            for v in self.specs.get_vhosts():
-                if service_alias == v["service_alias"]:
-                    if v["scheme"].lower() in ["ws", "wss"]:
-                        backend.append("option http-server-close")
-                        break
-
-            # To add an entry to backend section: append to backend
-            # To add items to a route: append to route_setting
-            balance = self._get_service_attr("balance", service_alias)
-            if balance:
-                backend.append("balance %s" % balance)
-
-            appsession = self._get_service_attr("appsession", service_alias)
-            if appsession:
-                backend.append("appsession %s" % appsession)
-                is_sticky = True
-
-            cookie = self._get_service_attr("cookie", service_alias)
-            if cookie:
-                backend.append("cookie %s" % cookie)
-                is_sticky = True
-
-            force_ssl = self._get_service_attr("force_ssl", service_alias)
-            if force_ssl:
-                backend.append("redirect scheme https code 301 if !{ ssl_fc }")
-
-            http_check = self._get_service_attr("http_check", service_alias)
-            if http_check:
-                backend.append("option httpchk %s" % http_check)
-
-            hsts_max_age = self._get_service_attr("hsts_max_age", service_alias)
-            if hsts_max_age:
-                backend.append("rspadd Strict-Transport-Security:\ max-age=%s;\ includeSubDomains" % hsts_max_age)
-
-            gzip_compression_type = self._get_service_attr('gzip_compression_type', service_alias)
-            if gzip_compression_type:
-                backend.append("compression algo gzip")
-                backend.append("compression type %s" % gzip_compression_type)
-
-            options = self._get_service_attr('option', service_alias)
-            if options:
-                for option in options:
-                    backend.append("option %s" % option)
-
-            extra_settings = self._get_service_attr('extra_settings', service_alias)
-            if extra_settings:
-                settings = re.split(r'(?<!\\),', extra_settings)
-                for setting in settings:
-                    if setting.strip():
-                        backend.append(setting.strip().replace("\,", ","))
-
-            if Haproxy.envvar_http_basic_auth:
-                backend.append("acl need_auth http_auth(haproxy_userlist)")
-                backend.append("http-request auth realm haproxy_basic_auth if !need_auth")
-
-            for _service_alias, routes in self.specs.get_routes().iteritems():
-                if not service_alias or _service_alias == service_alias:
-                    for route in routes:
-                        # avoid adding those tcp routes adding http backends
-                        if route in self.routes_added:
-                            continue
-
-                        backend_route = ["server %s %s:%s" % (route["container_name"], route["addr"], route["port"])]
-                        if is_sticky:
-                            backend_route.append("cookie %s" % route["container_name"])
-
-                        health_check = self._get_service_attr("health_check", service_alias)
-                        health_check = health_check if health_check else Haproxy.envvar_health_check
-                        backend_route.append(health_check)
-
-                        backend.append(" ".join(backend_route))
-
             if not service_alias:
                 if self.require_default_route:
-                    cfg["backend default_service"] = sorted(backend)
+                    inputs = (self.specs.version,)
+                    cfg["backend default_service"] = self._cached(
+                        "backend default_service", inputs, lambda: self._config_backend_service(service_alias))
             else:
                 if self._get_service_attr("virtual_host", service_alias):
-                    cfg["backend SERVICE_%s" % service_alias] = sorted(backend)
+                    name = "backend SERVICE_%s" % service_alias
                 else:
-                    cfg["backend default_service"] = sorted(backend)
+                    name = "backend default_service"
+                inputs = (self.specs.get_revision(service_alias), name)
+                cfg[name] = self._cached("backend service %s" % service_alias, inputs,
+                                         lambda: self._config_backend_service(service_alias))
         return cfg
 
+    def _config_backend_service(self, service_alias):
+        backend = []
+        is_sticky = False
+
+        # Add http-service-close option for websocket backend
+        is_websocket = False
+        for v in self.specs.get_service_vhosts(service_alias):
+            if v.is_websocket:
+                backend.append("option http-server-close")
+                is_websocket = True
+                break
+
+        if not is_websocket and Haproxy.envvar_mode == "http":
+            backend.extend(self._config_connection_reuse(service_alias))
+
+        # To add an entry to backend section: append to backend
+        # To add items to a route: append to route_setting
+        balance = self._get_service_attr("balance", service_alias)
+        if balance:
+            backend.append("balance %s" % balance)
+
+        appsession = self._get_service_attr("appsession", service_alias)
+        if appsession:
+            backend.append("appsession %s" % appsession)
+            is_sticky = True
+
+        cookie = self._get_service_attr("cookie", service_alias)
+        if cookie:
+            backend.append("cookie %s" % cookie)
+            is_sticky = True
+
+        force_ssl = self._get_service_attr("force_ssl", service_alias)
+        if force_ssl:
+            backend.append("redirect scheme https code 301 if !{ ssl_fc }")
+
+        http_check = self._get_service_attr("http_check", service_alias)
+        if http_check:
+            backend.append("option httpchk %s" % http_check)
+
+        hsts_max_age = self._get_service_attr("hsts_max_age", service_alias)
+        if hsts_max_age:
+            backend.append("rspadd Strict-Transport-Security:\ max-age=%s;\ includeSubDomains" % hsts_max_age)
+
+        gzip_compression_type = self._get_service_attr('gzip_compression_type', service_alias)
+        if gzip_compression_type:
+            backend.append("compression algo gzip")
+            backend.append("compression type %s" % gzip_compression_type)
+
+        options = self._get_service_attr('option', service_alias)
+        if options:
+            for option in options:
+                backend.append("option %s" % option)
+
+        extra_settings = self._get_service_attr('extra_settings', service_alias)
+        if extra_settings:
+            settings = re.split(r'(?<!\\),', extra_settings)
+            for setting in settings:
+                if setting.strip():
+                    backend.append(setting.strip().replace("\,", ","))
+
+        if Haproxy.envvar_http_basic_auth:
+            backend.append("acl need_auth http_auth(haproxy_userlist)")
+            backend.append("http-request auth realm haproxy_basic_auth if !need_auth")
+
+        if service_alias:
+            service_routes = [self.specs.get_routes().get(service_alias, [])]
+        else:
+            service_routes = self.specs.get_routes().itervalues()
+        backend_routes = []
+        for routes in service_routes:
+            for route in routes:
+                # avoid adding those tcp routes adding http backends
+                if route not in self.routes_added:
+                    backend_routes.append(route)
+
+        health_check = self._get_service_attr("health_check", service_alias)
+        health_check = health_check if health_check else Haproxy.envvar_health_check
+        server_limits = self._get_server_limits(service_alias)
+        pool_max_conn = self._get_service_attr("pool_max_conn", service_alias) or Haproxy.envvar_pool_max_conn
+        if pool_max_conn and "option http-server-close" not in backend and self.get_haproxy_version() >= (1, 9):
+            server_limits.append("pool-max-conn %s" % pool_max_conn)
+        server_slots = self._get_service_attr("server_slots", service_alias) or Haproxy.envvar_server_slots
+        if server_slots:
+            slots = self._assign_server_slots(service_alias, backend_routes, int(server_slots))
+            for index, route in enumerate(slots):
+                server_name = "slot%d" % (index + 1)
+                if route:
+                    backend_route = ["server %s %s:%s" % (server_name, route.addr, route.port)]
+                else:
+                    backend_route = ["server %s %s" % (server_name, Haproxy.const_empty_slot_addr)]
+                if is_sticky:
+                    backend_route.append("cookie %s" % server_name)
+                backend_route.append(health_check)
+                backend_route.extend(server_limits)
+                if not route:
+                    backend_route.append("disabled")
+
+                backend.append(" ".join(backend_route))
+        else:
+            for route in backend_routes:
+                backend_route = ["server %s %s:%s" % (route.container_name, route.addr, route.port)]
+                if is_sticky:
+                    backend_route.append("cookie %s" % route.container_name)
+                backend_route.append(health_check)
+                backend_route.extend(server_limits)
+
+                backend.append(" ".join(backend_route))
+
+        return sorted(backend)
+
+    def _config_connection_reuse(self, service_alias):
+        # HAProxy keeps the server connections alive by default, and from 1.6 on shares the idle ones between the
+        # clients: "safe" only sends the first request of a client over a connection another client opened.
+        # Closing options of the user are left alone unless keep-alive is explicitly set.
+        lines = []
+        keepalive = self._get_service_attr("keepalive", service_alias) or Haproxy.envvar_keepalive
+        if keepalive and keepalive.lower() in ["false", "off", "no"]:
+            return ["option http-server-close"]
+        if keepalive:
+            lines.append("option http-keep-alive")
+            lines.append("timeout http-keep-alive %s" % keepalive)
+        else:
+            options = [option.strip() for option in Haproxy.envvar_option] + \
+                      (self._get_service_attr("option", service_alias) or [])
+            if any(option in ["http-server-close", "httpclose", "forceclose"] for option in options):
+                return lines
+
+        http_reuse = self._get_service_attr("http_reuse", service_alias) or Haproxy.envvar_http_reuse
+        if http_reuse and self.get_haproxy_version() >= (1, 6):
+            lines.append("http-reuse %s" % http_reuse)
+        return lines
+
+    def _get_server_limits(self, service_alias):
+        # the connections a server takes at once, beyond which the requests queue in HAProxy, and the requests it
+        # can have queued before they are sent to another server
+        limits = []
+        maxconn = self._get_service_attr("maxconn", service_alias) or Haproxy.envvar_server_maxconn
+        if maxconn:
+            limits.append("maxconn %s" % maxconn)
+        maxqueue = self._get_service_attr("maxqueue", service_alias) or Haproxy.envvar_server_maxqueue
+        if maxqueue:
+            limits.append("maxqueue %s" % maxqueue)
+        return limits
+
+    @staticmethod
+    def _assign_server_slots(service_alias, routes, spare):
+        # Keeps every route in the slot it was given by the previous rebuild, so that scaling a service only fills or
+        # frees slots. The pool only grows when the new routes do not fit in its free slots, which needs a reload
+        # anyway, and then leaves `spare` slots free; it is trimmed back when more than twice that many slots at its
+        # end are free.
+        slot_keys = Haproxy.cls_server_slots.get(service_alias, [])
+        routes_by_key = OrderedDict()
+        for route in routes:
+            routes_by_key["%s:%s" % (route.container_name, route.port)] = route
+
+        slot_keys = [key if key in routes_by_key else None for key in slot_keys]
+        unassigned = [key for key in routes_by_key if key not in slot_keys]
+        free_slots = slot_keys.count(None)
+        if len(unassigned) > free_slots or not slot_keys:
+            slot_keys.extend([None] * (len(unassigned) - free_slots + spare))
+        for key in unassigned:
+            slot_keys[slot_keys.index(None)] = key
+
+        free_tail = 0
+        for key in reversed(slot_keys):
+            if key:
+                break
+            free_tail += 1
+        if free_tail > 2 * spare:
+            del slot_keys[len(slot_keys) - free_tail + spare:]
+
+        Haproxy.cls_server_slots[service_alias] = slot_keys
+        return [routes_by_key[key] if key else None for key in slot_keys]
+
     def _get_service_attr(self, attr_name, service_alias=None):
         # service is None, when there is no virtual host is set
         if service_alias:
-            try:
-                return self.specs.get_details()[service_alias][attr_name]
-            except:
-                return None
+            return getattr(self.specs.get_details().get(service_alias), attr_name, None)
 
         else:
             # Randomly pick a None value from the linked service
-            for _service_alias in self.specs.get_details().iterkeys():
-                if self.specs.get_details()[_service_alias][attr_name]:
-                    return self.specs.get_details()[_service_alias][attr_name]
+            for attr in self.specs.get_details().itervalues():
+                value = getattr(attr, attr_name)
+                if value:
+                    return value
             return None
 
+    @classmethod
+    def get_api(cls):
+        if not cls.cls_api:
+            user_agent = "python-tutum/%s" % tutum.__version__
+            if tutum.user_agent:
+                user_agent = "%s %s" % (tutum.user_agent, user_agent)
+            headers = {"Content-Type": "application/json", "User-Agent": user_agent}
+            headers.update(tutum.auth.get_auth_header())
+            cls.cls_api = ApiClient(tutum.rest_host, headers, timeout=cls.envvar_api_timeout,
+                                    budget=cls.envvar_api_budget, backoff=cls.const_api_backoff,
+                                    max_backoff=cls.const_api_max_backoff, cache_ttl=cls.envvar_api_cache_ttl)
+        return cls.cls_api
+
     @classmethod
     def fetch_tutum_obj(cls, uri):
         if not uri:
             return None
+        return cls.get_api().fetch(uri)
 
-        while True:
-            try:
-                obj = tutum.Utils.fetch_by_resource_uri(uri)
-                break
-            except Exception as e:
-                logger.error(e)
-                time.sleep(cls.const_api_retry)
-        return obj
+    @classmethod
+    def fetch_tutum_objs(cls, uris):
+        # fetches the objects concurrently
+        return cls.get_api().fetch_all(uris)
 
     @staticmethod
     def _parse_extra_bind_settings(extra_bind_settings):
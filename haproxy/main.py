@@ -5,52 +5,163 @@ import signal
 
 import tutum
 
+from api import ApiError
+from eventfilter import EventFilter
 from haproxy import Haproxy
+from metrics import Exporter, Sample
 from parser import parse_uuid_from_resource_uri
+from scheduler import Scheduler
+from tracing import tracer
 
 __version__ = "0.2.1"
 tutum.user_agent = "tutum-haproxy/%s" % __version__
 
 DEBUG = os.getenv("DEBUG", False)
 PIDFILE = "/tmp/tutum-haproxy.pid"
+EVENT_COALESCE_WINDOW = float(os.getenv("EVENT_COALESCE_WINDOW", 1))  # seconds
+EVENT_COALESCE_MAX_DELAY = float(os.getenv("EVENT_COALESCE_MAX_DELAY", 10))  # seconds
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 1000))
+PROFILE = os.getenv("PROFILE", False)
+PROFILE_FILE = os.getenv("PROFILE_FILE")
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", 20))
 
 logger = logging.getLogger("haproxy")
 
 
-def run_haproxy(msg=None):
+def run_haproxy(msg=None, service_uris=None):
     logger.info("==========BEGIN==========")
     if msg:
         logger.info(msg)
-    haproxy = Haproxy()
-    haproxy.update()
+    with tracer.trace("rebuild"):
+        haproxy = Haproxy(service_uris)
+        event_filter.update([Haproxy.cls_service_uri, Haproxy.cls_container_uri], Haproxy.cls_linked_services,
+                            Haproxy.cls_linked_containers)
+        haproxy.update()
+    if Haproxy.cls_api:
+        logger.info("Tutum events: %(accepted)d accepted, %(filtered)d filtered", event_filter.stats())
+        logger.info("Tutum API cache: %(hits)d hits, %(misses)d misses, %(revalidations)d revalidations",
+                    Haproxy.cls_api.stats())
+
+
+def run_scheduled_haproxy(msgs, service_uris):
+    msg = msgs[-1]
+    if len(msgs) > 1:
+        msg = "%s (coalesced with %d other events)" % (msg, len(msgs) - 1)
+    try:
+        run_haproxy(msg, service_uris)
+    except ApiError as e:
+        # the events are not lost, they are scheduled again
+        logger.error("Cannot fetch from Tutum API: %s", e)
+        scheduler.submit(msg, service_uris)
+
+
+scheduler = Scheduler(run_scheduled_haproxy, EVENT_COALESCE_WINDOW, EVENT_COALESCE_MAX_DELAY, EVENT_QUEUE_SIZE)
+event_filter = EventFilter()
 
 
 def tutum_event_handler(event):
+    if not event_filter.is_watched(event):
+        return
     logger.debug(event)
+    invalidate_tutum_cache(event)
+
     # When service scale up/down or container start/stop/terminate/redeploy, reload the service
-    if event.get("state", "") not in ["In progress", "Pending", "Terminating", "Starting", "Scaling", "Stopping"] and \
-                    event.get("type", "").lower() in ["container", "service"] and \
-                    len(set(Haproxy.cls_linked_services).intersection(set(event.get("parents", [])))) > 0:
+    if event_filter.is_relevant(event):
         msg = "Tutum event: %s %s is %s" % (
             event["type"], parse_uuid_from_resource_uri(event.get("resource_uri", "")), event["state"].lower())
-        run_haproxy(msg)
+        scheduler.submit(msg, set(event.get("parents", [])).union([event.get("resource_uri")]))
 
-    # Add/remove services linked to haproxy
+    # Add/remove services linked to haproxy, the service is fetched without blocking the websocket
     if event.get("state", "") == "Success" and Haproxy.cls_service_uri in event.get("parents", []):
-        service = Haproxy.fetch_tutum_obj(Haproxy.cls_service_uri)
-        service_endpoints = [srv.get("to_service") for srv in service.linked_to_service]
-        if Haproxy.cls_linked_services != service_endpoints:
-            services_unlinked = ", ".join([parse_uuid_from_resource_uri(uri) for uri in
-                                           set(Haproxy.cls_linked_services) - set(service_endpoints)])
-            services_linked = ", ".join([parse_uuid_from_resource_uri(uri) for uri in
-                                         set(service_endpoints) - set(Haproxy.cls_linked_services)])
-            msg = "Tutum event:"
-            if services_unlinked:
-                msg += " service %s is unlinked from HAProxy" % services_unlinked
-            if services_linked:
-                msg += " service %s is linked to HAProxy" % services_linked
-
-            run_haproxy(msg)
+        Haproxy.get_api().fetch_async(Haproxy.cls_service_uri, check_linked_services, check_linked_services_failed)
+
+
+def invalidate_tutum_cache(event):
+    # The HAProxy container lists the endpoints of the linked containers, and the HAProxy service lists the linked
+    # services: they are revalidated on the events that can change them, besides the resource of the event itself
+    api = Haproxy.get_api()
+    parents = event.get("parents", [])
+    api.invalidate(event.get("resource_uri"))
+    if any(parent in event_filter.linked_services for parent in parents):
+        api.invalidate(Haproxy.cls_container_uri)
+    if Haproxy.cls_service_uri in parents:
+        api.invalidate(Haproxy.cls_service_uri)
+
+
+def check_linked_services_failed(error):
+    # the links may have changed, and the events of a newly linked service are only watched after a rebuild
+    logger.error("Cannot check the services linked to HAProxy: %s", error)
+    scheduler.submit("Tutum event: services linked to HAProxy may have changed")
+
+
+def check_linked_services(service):
+    service_endpoints = [srv.get("to_service") for srv in service.linked_to_service]
+    if Haproxy.cls_linked_services != service_endpoints:
+        services_unlinked = ", ".join([parse_uuid_from_resource_uri(uri) for uri in
+                                       set(Haproxy.cls_linked_services) - set(service_endpoints)])
+        services_linked = ", ".join([parse_uuid_from_resource_uri(uri) for uri in
+                                     set(service_endpoints) - set(Haproxy.cls_linked_services)])
+        msg = "Tutum event:"
+        if services_unlinked:
+            msg += " service %s is unlinked from HAProxy" % services_unlinked
+        if services_linked:
+            msg += " service %s is linked to HAProxy" % services_linked
+
+        scheduler.submit(msg)
+
+
+def controller_metrics():
+    samples = []
+    for stage, (count, seconds) in sorted(tracer.timings.items()):
+        labels = (("stage", stage),)
+        samples.append(Sample("haproxy_controller_stage_duration_seconds_sum", "summary",
+                              "Time spent in the stages of the rebuilds", labels, seconds))
+        samples.append(Sample("haproxy_controller_stage_duration_seconds_count", "summary",
+                              "Time spent in the stages of the rebuilds", labels, count))
+
+    scheduler_stats = scheduler.stats()
+    samples.extend([
+        Sample("haproxy_controller_events_received_total", "counter", "Reconfiguration requests received", (),
+               scheduler_stats["events_received"]),
+        Sample("haproxy_controller_rebuilds_total", "counter", "Rebuilds performed", (),
+               scheduler_stats["rebuilds_performed"]),
+        Sample("haproxy_controller_queue_depth", "gauge", "Reconfiguration requests pending", (),
+               scheduler_stats["queue_depth"]),
+        Sample("haproxy_controller_queue_overflows_total", "counter", "Batches turned into a full rebuild", (),
+               scheduler_stats["overflows"]),
+        Sample("haproxy_controller_lag_seconds", "gauge", "Delay between the first request of a batch and its rebuild",
+               (), scheduler_stats["lag"])])
+    for result, count in sorted(event_filter.stats().items()):
+        samples.append(Sample("haproxy_controller_tutum_events_total", "counter", "Tutum events by filtering result",
+                              (("result", result),), count))
+
+    if Haproxy.cls_reloader:
+        reloader_stats = Haproxy.cls_reloader.stats()
+        samples.extend([
+            Sample("haproxy_controller_reloads_total", "counter", "Reloads of HAProxy", (), reloader_stats["reloads"]),
+            Sample("haproxy_controller_reload_latency_seconds", "gauge",
+                   "Time for the last reloaded process to answer on the stats socket", (),
+                   reloader_stats["last_latency"]),
+            Sample("haproxy_controller_draining_processes", "gauge", "Old HAProxy processes still draining", (),
+                   reloader_stats["draining"]),
+            Sample("haproxy_controller_hard_stops_total", "counter", "Old HAProxy processes stopped while draining",
+                   (), reloader_stats["hard_stops"])])
+
+    if Haproxy.cls_api:
+        api_stats = Haproxy.cls_api.stats()
+        for result in ["hits", "misses", "revalidations"]:
+            samples.append(Sample("haproxy_controller_api_cache_total", "counter", "Tutum API fetches by cache result",
+                                  (("result", result),), api_stats[result]))
+        samples.extend([
+            Sample("haproxy_controller_api_request_duration_seconds_sum", "summary",
+                   "Duration of the requests to the Tutum API", (), api_stats["request_time"]),
+            Sample("haproxy_controller_api_request_duration_seconds_count", "summary",
+                   "Duration of the requests to the Tutum API", (), api_stats["requests"])])
+    return samples
+
+
+def current_haproxy_pid():
+    return Haproxy.cls_haproxy_process.pid if Haproxy.cls_haproxy_process else None
 
 
 def create_pid_file():
@@ -63,16 +174,40 @@ def create_pid_file():
 
 
 def user_reload_haproxy(signum, frame):
-    run_haproxy("User reload")
+    if Haproxy.cls_api:
+        Haproxy.cls_api.invalidate_all()
+    scheduler.submit("User reload")
+
+
+def user_profile_haproxy(signum, frame):
+    tracer.profile_next = True
+    if Haproxy.cls_api:
+        Haproxy.cls_api.invalidate_all()
+    scheduler.submit("User profiled reload")
+
+
+def websocket_open():
+    # events may have been missed while the websocket was closed
+    Haproxy.get_api().invalidate_all()
+    scheduler.submit("Websocket open")
 
 
 def main():
     logging.basicConfig(stream=sys.stdout)
     logging.getLogger("haproxy").setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
+    tracer.profile_all = bool(PROFILE)
+    tracer.profile_file = PROFILE_FILE
+    tracer.profile_top = PROFILE_TOP
+
     pid = create_pid_file()
     signal.signal(signal.SIGUSR1, user_reload_haproxy)
+    signal.signal(signal.SIGUSR2, user_profile_haproxy)
     signal.signal(signal.SIGTERM, sys.exit)
+    scheduler.start()
+    if Haproxy.envvar_metrics_port:
+        Exporter(int(Haproxy.envvar_metrics_port), Haproxy.const_stats_socket, Haproxy.envvar_metrics_interval,
+                 [controller_metrics], current_haproxy_pid).start()
 
     if Haproxy.cls_container_uri and Haproxy.cls_service_uri:
         if Haproxy.cls_tutum_auth:
@@ -87,7 +222,7 @@ def main():
 
     if Haproxy.cls_container_uri and Haproxy.cls_service_uri and Haproxy.cls_tutum_auth:
         events = tutum.TutumEvents()
-        events.on_open(lambda: run_haproxy("Websocket open"))
+        events.on_open(websocket_open)
         events.on_close(lambda: logger.info("Websocket close"))
         events.on_message(tutum_event_handler)
         events.run_forever()
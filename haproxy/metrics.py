@@ -0,0 +1,203 @@
+import csv
+import logging
+import re
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import namedtuple, OrderedDict
+
+from runtime import RuntimeSession, RuntimeApiError
+
+logger = logging.getLogger("haproxy")
+
+Sample = namedtuple("Sample", ["name", "type", "help", "labels", "value"])
+
+# 'show stat' fields => (metric, type, help, scale)
+STAT_FIELDS = [
+    ("qcur", ("current_queue", "gauge", "Current number of queued requests", 1)),
+    ("scur", ("current_sessions", "gauge", "Current number of sessions", 1)),
+    ("slim", ("limit_sessions", "gauge", "Configured session limit", 1)),
+    ("stot", ("sessions_total", "counter", "Total number of sessions", 1)),
+    ("rate", ("current_session_rate", "gauge", "Number of sessions over the last second", 1)),
+    ("bin", ("bytes_in_total", "counter", "Bytes received from clients", 1)),
+    ("bout", ("bytes_out_total", "counter", "Bytes sent to clients", 1)),
+    ("dreq", ("requests_denied_total", "counter", "Requests denied for security reasons", 1)),
+    ("ereq", ("request_errors_total", "counter", "Request errors", 1)),
+    ("econ", ("connection_errors_total", "counter", "Errors connecting to a server", 1)),
+    ("eresp", ("response_errors_total", "counter", "Response errors", 1)),
+    ("wretr", ("retry_warnings_total", "counter", "Retries to connect to a server", 1)),
+    ("wredis", ("redispatch_warnings_total", "counter", "Requests redispatched to another server", 1)),
+    ("req_tot", ("http_requests_total", "counter", "Total number of HTTP requests", 1)),
+    ("weight", ("weight", "gauge", "Weight of the server, or total weight of the backend", 1)),
+    ("chkfail", ("check_failures_total", "counter", "Failed health checks", 1)),
+    ("downtime", ("downtime_seconds_total", "counter", "Time spent down", 1)),
+    ("qtime", ("queue_time_average_seconds", "gauge", "Average queue time over the last 1024 requests", 0.001)),
+    ("ctime", ("connect_time_average_seconds", "gauge", "Average connect time over the last 1024 requests", 0.001)),
+    ("rtime", ("response_time_average_seconds", "gauge", "Average response time over the last 1024 requests", 0.001)),
+    ("ttime", ("total_time_average_seconds", "gauge", "Average total time over the last 1024 requests", 0.001)),
+]
+STAT_TYPES = {"0": "frontend", "1": "backend", "2": "server"}
+STAT_CODES = ["1xx", "2xx", "3xx", "4xx", "5xx", "other"]
+
+
+def parse_info(text):
+    # 'CurrConns: 3' => haproxy_process_curr_conns 3, the values that are not numbers are left out
+    samples = []
+    for line in text.splitlines():
+        key, _, value = line.partition(":")
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        name = "haproxy_process_%s" % re.sub(r"(?<=[a-z0-9])(?=[A-Z])", "_", key.strip()).lower()
+        samples.append(Sample(name, "gauge", "HAProxy process %s" % key.strip(), (), value))
+    return samples
+
+
+def parse_stat(text):
+    # the CSV lines of the frontends, backends and servers, the listeners are left out
+    rows = csv.reader(line for line in text.lstrip("# ").splitlines() if line)
+    columns = dict((field, index) for index, field in enumerate(next(rows, [])))
+    fields = [(columns[field], metric) for field, metric in STAT_FIELDS if field in columns]
+    codes = [(columns["hrsp_%s" % code], code) for code in STAT_CODES if "hrsp_%s" % code in columns]
+    pxname, svname, status, stat_type = [columns.get(field) for field in ["pxname", "svname", "status", "type"]]
+
+    samples = []
+    for row in rows:
+        kind = STAT_TYPES.get(row[stat_type]) if stat_type is not None and stat_type < len(row) else None
+        if not kind:
+            continue
+        if kind == "server":
+            labels = (("backend", row[pxname]), ("server", row[svname]))
+        else:
+            labels = ((kind, row[pxname]),)
+        prefix = "haproxy_%s_" % kind
+
+        samples.append(Sample(prefix + "up", "gauge", "Whether the %s is up" % kind, labels,
+                              1 if row[status].startswith(("UP", "OPEN")) else 0))
+        for index, (name, metric_type, help_text, scale) in fields:
+            if row[index]:
+                samples.append(Sample(prefix + name, metric_type, help_text, labels, float(row[index]) * scale))
+        for index, code in codes:
+            if row[index]:
+                samples.append(Sample(prefix + "http_responses_total", "counter", "HTTP responses by status class",
+                                      labels + (("code", code),), float(row[index])))
+    return samples
+
+
+def render(samples):
+    # the text exposition format, the samples of a metric being grouped under its HELP and TYPE lines; the samples of
+    # a summary are named after it with a _sum or _count suffix
+    metrics = OrderedDict()
+    for sample in samples:
+        name = re.sub(r"_(sum|count)$", "", sample.name) if sample.type == "summary" else sample.name
+        metrics.setdefault(name, []).append(sample)
+    formatted_labels = {(): ""}  # the samples of a row share their labels
+    lines = []
+    for name, metric_samples in metrics.iteritems():
+        lines.append("# HELP %s %s" % (name, metric_samples[0].help))
+        lines.append("# TYPE %s %s" % (name, metric_samples[0].type))
+        for sample in metric_samples:
+            labels = formatted_labels.get(sample.labels)
+            if labels is None:
+                labels = formatted_labels[sample.labels] = "{%s}" % ",".join(
+                    '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for key, value in sample.labels)
+            lines.append("%s%s %r" % (sample.name, labels, float(sample.value)))
+    return "\n".join(lines) + "\n"
+
+
+class Exporter(object):
+    # Serves the HAProxy statistics and the metrics of the controller over HTTP for Prometheus. HAProxy is polled
+    # every `interval` seconds over a single persistent connection to the stats socket, and scrapes are answered from
+    # the last poll. A connection held to an old process would keep it from finishing its reload, so the connection is
+    # opened again as soon as `current_pid` no longer is the process answering.
+    # The collectors are called on every scrape and return the samples of the controller.
+    def __init__(self, port, stats_socket, interval, collectors=(), current_pid=None):
+        self.port = port
+        self.interval = interval
+        self.collectors = collectors
+        self.current_pid = current_pid
+        self.session = RuntimeSession(stats_socket)
+        self.samples = []
+        self.text = ""
+        self.up = 0
+        self.polls = 0
+        self.poll_errors = 0
+        self.poll_duration = 0
+        self.server = None
+
+    def start(self):
+        self.server = MetricsServer(("", self.port), self)
+        for name, target in [("metrics-poller", self._poll_forever), ("metrics-server", self.server.serve_forever)]:
+            worker = threading.Thread(target=target, name=name)
+            worker.daemon = True
+            worker.start()
+        logger.info("Serving metrics on port %d", self.server.server_address[1])
+
+    def poll(self):
+        start = time.time()
+        try:
+            info = self.session.execute("show info")
+            pid = re.search(r"^Pid: (\d+)$", info, re.MULTILINE)
+            current_pid = self.current_pid() if self.current_pid else None
+            if current_pid and pid and int(pid.group(1)) != current_pid:
+                self.session.close()
+                info = self.session.execute("show info")
+            self.samples = parse_info(info) + parse_stat(self.session.execute("show stat"))
+            self.text = render(self.samples)
+            self.up = 1
+        except RuntimeApiError as e:
+            self.session.close()
+            self.samples = []
+            self.text = ""
+            self.up = 0
+            self.poll_errors += 1
+            logger.debug("Cannot poll HAProxy statistics: %s", e)
+        self.polls += 1
+        self.poll_duration = time.time() - start
+
+    def scrape(self):
+        # the statistics of HAProxy are rendered once per poll, the metrics of the controller on every scrape
+        samples = [Sample("haproxy_up", "gauge", "Whether the last poll of HAProxy succeeded", (), self.up),
+                   Sample("haproxy_exporter_polls_total", "counter", "Polls of HAProxy", (), self.polls),
+                   Sample("haproxy_exporter_poll_errors_total", "counter", "Failed polls of HAProxy", (),
+                          self.poll_errors),
+                   Sample("haproxy_exporter_poll_duration_seconds", "gauge", "Duration of the last poll of HAProxy",
+                          (), self.poll_duration)]
+        for collector in self.collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                logger.exception(e)
+        return render(samples) + self.text
+
+    def _poll_forever(self):
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, exporter):
+        HTTPServer.__init__(self, address, MetricsHandler)
+        self.exporter = exporter
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        content = self.server.exporter.scrape()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
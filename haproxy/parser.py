@@ -1,6 +1,54 @@
 import re
 import os
 import urlparse
+from collections import OrderedDict, namedtuple
+
+
+# A server of a linked service. Routes are hashable, so that they can be deduplicated and looked up in sets.
+Route = namedtuple("Route", ["proto", "addr", "port", "container_name"])
+
+
+class VirtualHost(object):
+    # A virtual host of a service, with its scheme lowercased and its host and path stripped
+    __slots__ = ("scheme", "host", "port", "path", "service_alias", "is_ssl", "is_websocket")
+
+    def __init__(self, scheme, host, port, path, service_alias):
+        self.scheme = scheme.lower()
+        self.host = host.strip("/")
+        self.port = port.strip()
+        self.path = path.strip()
+        self.service_alias = service_alias
+        self.is_ssl = self.scheme in ["https", "wss"]
+        self.is_websocket = self.scheme in ["ws", "wss"]
+
+    def __eq__(self, other):
+        return isinstance(other, VirtualHost) and \
+            all(getattr(self, attr_name) == getattr(other, attr_name) for attr_name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "VirtualHost(%s://%s:%s%s of %s)" % (self.scheme, self.host, self.port, self.path, self.service_alias)
+
+
+class ServiceDetails(object):
+    # The settings of a service, one attribute per EnvParser.parse_* method, plus the raw virtual_host_str
+    __slots__ = ("default_ssl_cert", "ssl_cert", "exclude_ports", "virtual_host", "virtual_host_str", "force_ssl",
+                 "appsession", "balance", "cookie", "tcp_ports", "health_check", "http_check", "virtual_host_weight",
+                 "hsts_max_age", "gzip_compression_type", "option", "extra_settings", "server_slots",
+                 "maxconn", "maxqueue", "http_reuse", "keepalive", "pool_max_conn")
+
+    def __init__(self):
+        for attr_name in self.__slots__:
+            setattr(self, attr_name, None)
+
+    def __eq__(self, other):
+        return isinstance(other, ServiceDetails) and \
+            all(getattr(self, attr_name) == getattr(other, attr_name) for attr_name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
 
 
 def parse_uuid_from_resource_uri(uri):
@@ -15,19 +63,92 @@ class Specs(object):
     detailed_service_alias_match = re.compile(r"_\d+_PORT_\d{1,5}_(TCP|UDP)$")
 
     def __init__(self, tutum_haproxy_container=None, tutum_haproxy_service=None):
+        # version is bumped whenever a service changes, revisions records the version each service last changed in,
+        # and dirty holds the services changed by the last parse or update; merged maps each service sharing the
+        # virtual host of another one to the service it is merged into
+        self.version = 0
+        self.revisions = {}
+        self.dirty = set()
+        self.merged = {}
+        self._parse_all(tutum_haproxy_container, tutum_haproxy_service)
+
+    def update(self, tutum_haproxy_container, tutum_haproxy_service, service_uris):
+        # Only re-parse the services referred by service_uris and the services whose environment variables changed.
+        # Everything is parsed again if service_uris is None or if the linked services changed.
+        previous_envvars = self.envvars
+        previous_details = self.linked_details
+        previous_routes = self.linked_routes
+
+        self.envvars = self._parse_envvars(tutum_haproxy_container)
+        service_aliases = self._parser_service_aliases(tutum_haproxy_service)
+        if service_uris is None or set(service_aliases) != set(self.linked_service_aliases):
+            self._parse_all(tutum_haproxy_container, tutum_haproxy_service)
+            return
+
+        self.linked_service_aliases = service_aliases
+        self.service_uris = self._parse_service_uris(tutum_haproxy_service)
+        service_aliases = set([self.service_uris[uri] for uri in service_uris if uri in self.service_uris])
+        for key in set(self.envvars.iterkeys()).symmetric_difference(previous_envvars.iterkeys()):
+            service_aliases.update(self._get_service_aliases_of_key(key))
+        for key, value in self.envvars.iteritems():
+            if key in previous_envvars and previous_envvars[key] != value:
+                service_aliases.update(self._get_service_aliases_of_key(key))
+
+        details = self._parse_details(list(service_aliases))
+        routes = RouteParser.parse(details, tutum_haproxy_container, service_aliases)
+        self.linked_details = dict(previous_details)
+        self.linked_details.update(details)
+        self.linked_routes = dict(previous_routes)
+        changed = set()
+        for service_alias in service_aliases:
+            self.linked_routes.pop(service_alias, None)
+            if service_alias in routes:
+                self.linked_routes[service_alias] = routes[service_alias]
+            if previous_details.get(service_alias) != self.linked_details.get(service_alias) or \
+                    previous_routes.get(service_alias) != self.linked_routes.get(service_alias):
+                changed.add(service_alias)
+        self._merge(changed)
+
+    def _parse_all(self, tutum_haproxy_container, tutum_haproxy_service):
+        previous_service_aliases = set(getattr(self, "linked_service_aliases", []))
         self.envvars = self._parse_envvars(tutum_haproxy_container)
-        self.service_aliases = self._parser_service_aliases(tutum_haproxy_service)
-        self.details = self._parse_details()
-        self.routes = self._parse_routes(tutum_haproxy_container)
+        self.linked_service_aliases = self._parser_service_aliases(tutum_haproxy_service)
+        self.service_uris = self._parse_service_uris(tutum_haproxy_service)
+        self.linked_details = self._parse_details(self.linked_service_aliases)
+        self.linked_routes = self._parse_routes(self.linked_details, tutum_haproxy_container)
+        self._merge(previous_service_aliases.union(self.linked_service_aliases))
+
+    def _merge(self, changed):
+        self.service_aliases = list(self.linked_service_aliases)
+        self.details = dict(self.linked_details)
+        self.routes = dict([(service_alias, list(routes)) for service_alias, routes in self.linked_routes.iteritems()])
+        # a service joining or leaving a merge changes the backend of the service it is merged into, before and after
+        merged = self.merge_services_with_same_vhost()
+        for service_alias in set(merged).union(self.merged):
+            if service_alias in changed or merged.get(service_alias) != self.merged.get(service_alias):
+                changed.add(service_alias)
+                changed.update(target for target in [merged.get(service_alias), self.merged.get(service_alias)]
+                               if target)
+        self.merged = merged
         self.vhosts = self._parse_vhosts()
-        self.merge_services_with_same_vhost()
+        self.vhosts_by_port, self.vhosts_by_service = self._index_vhosts(self.vhosts)
+        self.default_ssl_cert = None
+        self.ssl_cert = None
+        self.force_ssl = None
+
+        self.dirty = changed
+        if changed:
+            self.version += 1
+            for service_alias in changed:
+                self.revisions[service_alias] = self.version
 
     def merge_services_with_same_vhost(self):
         services_with_same_vhost = {}
         unique_vhost = {}
 
-        for service_alias, detail in self.details.iteritems():
-            vhost_str = detail['virtual_host_str']
+        # the first service in alphabetical order is kept, whichever services were parsed
+        for service_alias, detail in sorted(self.details.iteritems()):
+            vhost_str = detail.virtual_host_str
             if vhost_str:
                 if vhost_str in unique_vhost:
                     services_with_same_vhost[service_alias] = unique_vhost[vhost_str]
@@ -38,15 +159,10 @@ class Specs(object):
             self.service_aliases.remove(service_alias)
             del self.details[service_alias]
 
-            for route in self.routes[service_alias]:
-                self.routes[services_with_same_vhost[service_alias]].append(route)
-            del self.routes[service_alias]
-
-            vhosts = []
-            for vhost in self.vhosts:
-                if vhost['service_alias'] != service_alias:
-                    vhosts.append(vhost)
-            self.vhosts = vhosts
+            for route in self.routes.get(service_alias, []):
+                self.routes.setdefault(services_with_same_vhost[service_alias], []).append(route)
+            self.routes.pop(service_alias, None)
+        return services_with_same_vhost
 
     def _parse_envvars(self, tutum_haproxy_container):
         envvars = {}
@@ -76,63 +192,75 @@ class Specs(object):
                         service_aliases.append(alias)
         return service_aliases
 
-    def _parse_details(self):
-        env_parser = EnvParser(self.service_aliases)
+    @staticmethod
+    def _parse_service_uris(tutum_haproxy_services):
+        service_uris = {}
+        if tutum_haproxy_services:
+            for service in tutum_haproxy_services.linked_to_service:
+                service_uris[service.get("to_service")] = service["name"].upper().replace("-", "_")
+        return service_uris
+
+    def _get_service_aliases_of_key(self, key):
+        return [service_alias for service_alias in self.linked_service_aliases if key.startswith(service_alias + "_")]
+
+    def _parse_details(self, service_aliases):
+        env_parser = EnvParser(service_aliases)
         for key, value in self.envvars.iteritems():
             env_parser.parse(key, value)
         details = env_parser.get_details()
 
         # generate empty details if there is no environment variables set in the application services
-        for service_alias in set(self.service_aliases) - set(details.iterkeys()):
+        for service_alias in set(service_aliases) - set(details.iterkeys()):
             env_parser.parse(service_alias + "_ENV_", "")
 
-        return env_parser.get_details()
+        details = env_parser.get_details()
+        for service_alias, attr in details.iteritems():
+            self._parse_virtual_host(attr, service_alias)
+        return details
 
-    def _parse_routes(self, tutum_haproxy_container):
-        return RouteParser.parse(self.details, tutum_haproxy_container)
+    @staticmethod
+    def _parse_routes(details, tutum_haproxy_container):
+        return RouteParser.parse(details, tutum_haproxy_container)
 
-    def _parse_vhosts(self):
+    @staticmethod
+    def _parse_virtual_host(attr, service_alias):
         # copy virtual_host to vritual_host_str, and then parse virtual_host
         # 'http://a.com:8080, https://b.com, c.com'  = >
-        #   [{'path': '', 'host': 'a.com', 'scheme': 'http', 'port': '8080'},
-        #    {'path': '', 'host': 'b.com', 'scheme': 'https', 'port': '443'},
-        #    {'path': '', 'host': 'c.com', 'scheme': 'http', 'port': '80'}]
+        #   [VirtualHost(http://a.com:8080 of WEB), VirtualHost(https://b.com:443 of WEB),
+        #    VirtualHost(http://c.com:80 of WEB)]
+        virtual_host_str = attr.virtual_host_str = attr.virtual_host
+
         parsed_virtual_host = []
-        for service_alias, attr in self.details.iteritems():
-            virtual_host_str = attr["virtual_host_str"] = attr["virtual_host"]
-
-            parsed_virtual_host = []
-            if virtual_host_str:
-                for h in [h.strip() for h in virtual_host_str.strip().split(",")]:
-                    pr = urlparse.urlparse(h)
-                    if not pr.netloc:
-                        pr = urlparse.urlparse("http://%s" % h)
-                    port = '443' if pr.scheme.lower() in ['https', 'wss'] else "80"
-                    host = pr.netloc
-                    if ":" in pr.netloc:
-                        host_port = pr.netloc.split(":")
-                        host = host_port[0]
-                        port = host_port[1]
-                    parsed_virtual_host.append({"scheme": pr.scheme,
-                                                "host": host,
-                                                "port": port,
-                                                "path": pr.path})
-            self.details[service_alias]["virtual_host"] = parsed_virtual_host
+        if virtual_host_str:
+            for h in [h.strip() for h in virtual_host_str.strip().split(",")]:
+                pr = urlparse.urlparse(h)
+                if not pr.netloc:
+                    pr = urlparse.urlparse("http://%s" % h)
+                port = '443' if pr.scheme.lower() in ['https', 'wss'] else "80"
+                host = pr.netloc
+                if ":" in pr.netloc:
+                    host_port = pr.netloc.split(":")
+                    host = host_port[0]
+                    port = host_port[1]
+                parsed_virtual_host.append(VirtualHost(pr.scheme, host, port, pr.path, service_alias))
+        attr.virtual_host = parsed_virtual_host
 
+    def _parse_vhosts(self):
+        # in the order of the service aliases, so that an incremental update renders the same configuration
         vhosts = []
-        for service_alias, attr in self.details.iteritems():
-            virtual_hosts = attr["virtual_host"]
-
-            if virtual_hosts:
-                for v in virtual_hosts:
-                    vhost = dict(v)
-                    vhost["service_alias"] = service_alias
-                    vhosts.append(vhost)
-        try:
-            return sorted(vhosts, key=lambda vhost: self.details[vhost["service_alias"]]["virtual_host_weight"],
-                          reverse=True)
-        except:
-            return vhosts
+        for service_alias in sorted(self.details):
+            vhosts.extend(self.details[service_alias].virtual_host)
+        return sorted(vhosts, key=lambda vhost: self.details[vhost.service_alias].virtual_host_weight, reverse=True)
+
+    @staticmethod
+    def _index_vhosts(vhosts):
+        # both indexes keep the order of vhosts
+        vhosts_by_port = OrderedDict()
+        vhosts_by_service = {}
+        for vhost in vhosts:
+            vhosts_by_port.setdefault(vhost.port, []).append(vhost)
+            vhosts_by_service.setdefault(vhost.service_alias, []).append(vhost)
+        return vhosts_by_port, vhosts_by_service
 
     def get_details(self):
         return self.details
@@ -143,28 +271,37 @@ class Specs(object):
     def get_vhosts(self):
         return self.vhosts
 
+    def get_vhosts_by_port(self):
+        return self.vhosts_by_port
+
+    def get_service_vhosts(self, service_alias):
+        return self.vhosts_by_service.get(service_alias, [])
+
     def get_default_ssl_cert(self):
-        if not hasattr(self, "default_ssl_cert"):
+        if self.default_ssl_cert is None:
             self.default_ssl_cert = filter(lambda x: x,
-                                           [attr["default_ssl_cert"] for attr in self.details.itervalues()])
+                                           [self.details[alias].default_ssl_cert for alias in sorted(self.details)])
         return self.default_ssl_cert
 
     def get_ssl_cert(self):
-        if not hasattr(self, "ssl_cert"):
-            self.ssl_cert = filter(lambda x: x, [attr["ssl_cert"] for attr in self.details.itervalues()])
+        if self.ssl_cert is None:
+            self.ssl_cert = filter(lambda x: x, [self.details[alias].ssl_cert for alias in sorted(self.details)])
         return self.ssl_cert
 
     def get_force_ssl(self):
-        if not hasattr(self, "force_ssl"):
+        if self.force_ssl is None:
             self.force_ssl = []
             for service_alias, attr in self.details.iteritems():
-                if attr["force_ssl"]:
+                if attr.force_ssl:
                     self.force_ssl.append(service_alias)
         return self.force_ssl
 
     def get_service_aliases(self):
         return self.service_aliases
 
+    def get_revision(self, service_alias):
+        return self.revisions.get(service_alias, 0)
+
 
 class RouteParser(object):
     backend_match = re.compile(r"(?P<proto>tcp|udp):\/\/(?P<addr>[^:]*):(?P<port>.*)")
@@ -172,14 +309,16 @@ class RouteParser(object):
     detailed_service_alias_match = re.compile(r"_\d+_PORT_\d{1,5}_(TCP|UDP)$")
 
     @staticmethod
-    def parse(details, tutum_haproxy_container=None):
+    def parse(details, tutum_haproxy_container=None, service_aliases=None):
+        # service_aliases restricts the parsing to the routes of the given services
         if tutum_haproxy_container:
-            return RouteParser.parse_tutum_routes(details, tutum_haproxy_container.linked_to_container)
+            return RouteParser.parse_tutum_routes(details, tutum_haproxy_container.linked_to_container,
+                                                  service_aliases)
         else:
-            return RouteParser.parse_local_routes(details, os.environ)
+            return RouteParser.parse_local_routes(details, os.environ, service_aliases)
 
     @staticmethod
-    def parse_tutum_routes(details, container_links):
+    def parse_tutum_routes(details, container_links, service_aliases=None):
         # Input:  details         = {'HELLO_1': {'exclude_ports': ['3306']}}
         #         container_links = [{"endpoints": {"80/tcp": "tcp://10.7.0.3:80", "3306/tcp": "tcp://10.7.0.8:3306"},
         #                             "name": "hello-1",
@@ -189,19 +328,20 @@ class RouteParser(object):
         #                              "name": "hello-2",
         #                              "from_container": "/api/v1/container/702d18d4-7934-4715-aea3-c0637f1a4129/",
         #                              "to_container": "/api/v1/container/65b18c61-b551-4c7f-a92b-06ef95494d5a/"}]
-        # Output: links           = {'HELLO': [{'proto': 'tcp', 'addr': '10.7.0.3', 'port': '80'},
-        #                                      {'proto': 'tcp', 'addr': '10.7.0.5', 'port': '80'}]
+        # Output: links           = {'HELLO': [Route(proto='tcp', addr='10.7.0.3', port='80', container_name='HELLO_1'),
+        #                                      Route(proto='tcp', addr='10.7.0.5', port='80', container_name='HELLO_2')]
         routes = {}
         for container_link in container_links:
             container_name = container_link.get("name").upper().replace("-", "_")
             pos = container_name.rfind("_")
             if pos > 0:
                 service_alias = container_name[:pos]
+                if service_aliases is not None and service_alias not in service_aliases:
+                    continue
                 for _, value in container_link.get("endpoints", {}).iteritems():
-                    route = RouteParser.backend_match.match(value).groupdict()
-                    route.update({"container_name": container_name})
-                    exclude_ports = details.get(service_alias, {}).get("exclude_ports")
-                    if not exclude_ports or (exclude_ports and route["port"] not in exclude_ports):
+                    route = Route(container_name=container_name, **RouteParser.backend_match.match(value).groupdict())
+                    exclude_ports = getattr(details.get(service_alias), "exclude_ports", None)
+                    if not exclude_ports or (exclude_ports and route.port not in exclude_ports):
                         if service_alias in routes:
                             routes[service_alias].append(route)
                         else:
@@ -209,15 +349,15 @@ class RouteParser(object):
         return routes
 
     @staticmethod
-    def parse_local_routes(details, envvars):
+    def parse_local_routes(details, envvars, service_aliases=None):
         # Input:  details = {'HELLO_1': {'exclude_ports': [3306]}}
         #         envvars = {'HELLO_1_PORT_80_TCP': 'tcp://172.17.0.30:80',
         #                    'HELLO_2_PORT_80_TCP': 'tcp://172.17.0.31:80',
         #                    'HELLO_1_PORT_3306_TCP': 'tcp://172.17.0.30:3306',
         #                    'HELLO_2_PORT_3306_TCP': 'tcp://172.17.0.31:3306'}
-        # Output: routes  = {'HELLO_2': [{'proto': 'tcp', 'port': '3306', 'addr': '172.17.0.31'},
-        #                                {'proto': 'tcp', 'port': '80', 'addr': '172.17.0.31'}],
-        #                    'HELLO_1': [{'proto': 'tcp', 'port': '80', 'addr': '172.17.0.30'}]}
+        # Output: routes  = {'HELLO_2': [Route(proto='tcp', addr='172.17.0.31', port='3306', container_name='HELLO_2'),
+        #                                Route(proto='tcp', addr='172.17.0.31', port='80', container_name='HELLO_2')],
+        #                    'HELLO_1': [Route(proto='tcp', addr='172.17.0.30', port='80', container_name='HELLO_1')]}
         routes = {}
         for key, value in envvars.iteritems():
             if not key or not value:
@@ -229,26 +369,23 @@ class RouteParser(object):
                     service_alias = key[:detailed_match.start()]
                 else:
                     service_alias = key[:match.start()]
+                if service_aliases is not None and service_alias not in service_aliases:
+                    continue
 
                 container_name = key[:match.start()]
 
                 be_match = RouteParser.backend_match.match(value)
                 if be_match:
-                    route = RouteParser.backend_match.match(value).groupdict()
-
-                    route.update({"container_name": container_name})
-                    exclude_ports = details.get(service_alias, {}).get("exclude_ports")
-                    if not exclude_ports or (exclude_ports and route["port"] not in exclude_ports):
-                        if service_alias in routes:
-                            # Avoid add the dulicated route twice(remove the first one, which is inject as the service name
-                            for _route in routes[service_alias]:
-                                if route['proto'] == _route['proto'] and \
-                                                route['port'] == _route['port'] and \
-                                                route['addr'] == _route['addr']:
-                                    routes[service_alias].remove(_route)
-                            routes[service_alias].append(route)
-                        else:
-                            routes[service_alias] = [route]
+                    route = Route(container_name=container_name, **be_match.groupdict())
+                    exclude_ports = getattr(details.get(service_alias), "exclude_ports", None)
+                    if not exclude_ports or (exclude_ports and route.port not in exclude_ports):
+                        # A server is injected both as the service and as its container: the last one replaces the
+                        # first one
+                        service_routes = routes.setdefault(service_alias, OrderedDict())
+                        service_routes.pop((route.proto, route.addr, route.port), None)
+                        service_routes[(route.proto, route.addr, route.port)] = route
+        for service_alias, service_routes in routes.iteritems():
+            routes[service_alias] = service_routes.values()
         return routes
 
 
@@ -256,36 +393,47 @@ class EnvParser(object):
     service_alias_match = re.compile(r"_ENV_")
     detailed_service_alias_match = re.compile(r"_\d+_ENV")
 
+    parsers = None
+
     def __init__(self, service_aliases):
-        self.service_aliases = service_aliases
+        self.service_aliases = set(service_aliases)
         self.details = {}
 
+    @classmethod
+    def get_parsers(cls):
+        # {'BALANCE': ('balance', parse_balance), ...}, built once from the parse_* methods
+        if cls.parsers is None:
+            cls.parsers = dict((method[6:].upper(), (method[6:], getattr(cls, method)))
+                               for method in dir(cls) if method.startswith("parse_"))
+        return cls.parsers
+
     def parse(self, key, value):
-        for method in self.__class__.__dict__:
-            if method.startswith("parse_"):
-                match = EnvParser.service_alias_match.search(key)
-                if match:
-                    detailed_match = EnvParser.detailed_service_alias_match.search(key)
-                    if detailed_match:
-                        service_alias = key[:detailed_match.start()]
-                    else:
-                        service_alias = key[:match.start()]
+        match = EnvParser.service_alias_match.search(key)
+        if not match:
+            return
 
-                    if service_alias in self.service_aliases:
-                        attr_name = method[6:]
-                        if key.endswith("_ENV_%s" % attr_name.upper()):
-                            attr_value = getattr(self, method)(value)
-                        else:
-                            attr_value = getattr(self, method)(None)
-
-                        if service_alias in self.details:
-                            if attr_name in self.details[service_alias]:
-                                if attr_value:
-                                    self.details[service_alias][attr_name] = attr_value
-                            else:
-                                self.details[service_alias][attr_name] = attr_value
-                        else:
-                            self.details[service_alias] = {attr_name: attr_value}
+        detailed_match = EnvParser.detailed_service_alias_match.search(key)
+        if detailed_match:
+            service_alias = key[:detailed_match.start()]
+        else:
+            service_alias = key[:match.start()]
+        if service_alias not in self.service_aliases:
+            return
+
+        # the first variable of a service sets the defaults of all the attributes, later ones only set a value
+        parsers = self.get_parsers()
+        details = self.details.get(service_alias)
+        first_seen = details is None
+        if first_seen:
+            details = self.details[service_alias] = ServiceDetails()
+            for attr_name, parser in parsers.itervalues():
+                setattr(details, attr_name, parser(None))
+
+        attr_name, parser = parsers.get(key[key.rindex("_ENV_") + 5:], (None, None))
+        if parser:
+            attr_value = parser(value)
+            if attr_value or first_seen:
+                setattr(details, attr_name, attr_value)
 
     def get_details(self):
         return self.details
@@ -366,3 +514,39 @@ class EnvParser(object):
     @staticmethod
     def parse_extra_settings(value):
         return value
+
+    @staticmethod
+    def parse_server_slots(value):
+        try:
+            return int(value)
+        except:
+            return 0
+
+    @staticmethod
+    def parse_maxconn(value):
+        try:
+            return int(value)
+        except:
+            return 0
+
+    @staticmethod
+    def parse_maxqueue(value):
+        try:
+            return int(value)
+        except:
+            return 0
+
+    @staticmethod
+    def parse_http_reuse(value):
+        return value
+
+    @staticmethod
+    def parse_keepalive(value):
+        return value
+
+    @staticmethod
+    def parse_pool_max_conn(value):
+        try:
+            return int(value)
+        except:
+            return 0
@@ -0,0 +1,165 @@
+import logging
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+from runtime import RuntimeApi, RuntimeApiError
+
+logger = logging.getLogger("haproxy")
+
+
+def detect_haproxy_version(binary):
+    # 'HA-Proxy version 1.5.18 2016/05/10' => (1, 5), () if unknown
+    try:
+        process = subprocess.Popen([binary, "-v"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+    except Exception as e:
+        logger.warning("Cannot detect the version of HAProxy: %s", e)
+        return ()
+    match = re.search(r"version (\d+)\.(\d+)", output or "")
+    if not match:
+        return ()
+    return int(match.group(1)), int(match.group(2))
+
+
+def check_haproxy_config(binary, config_file):
+    # runs 'haproxy -c' on the configuration, returns None if it is valid and the errors otherwise
+    try:
+        process = subprocess.Popen([binary, "-c", "-f", config_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+    except Exception as e:
+        return "Cannot run %s: %s" % (binary, e)
+    if process.returncode == 0:
+        return None
+    return (output or "").strip() or "exit status %s" % process.returncode
+
+
+class Reloader(object):
+    # Launches and reloads HAProxy. Reloads are at least `min_interval` seconds apart, and each one waits until the
+    # new process answers on the stats socket, which gives the reload latency. The old processes drain their
+    # connections: they are hard stopped after `drain_timeout` seconds, and the oldest ones are hard stopped when
+    # more than `max_draining` are left. With `socket_handoff`, the new process takes the listening sockets over
+    # from the old one (-x, HAProxy 1.8+), so that no connection is refused during the reload.
+    ready_timeout = 10  # seconds
+
+    def __init__(self, command, stats_socket, min_interval=0, max_draining=0, drain_timeout=0, socket_handoff=False):
+        self.command = command
+        self.stats_socket = stats_socket
+        self.min_interval = min_interval
+        self.max_draining = max_draining
+        self.drain_timeout = drain_timeout
+        self.socket_handoff = socket_handoff
+        self.process = None
+        self.reloads = 0
+        self.hard_stops = 0
+        self.last_latency = 0
+        self._last_reload = 0
+        self._draining = OrderedDict()  # pid => (process, draining since)
+        self._stopping = set()
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def run(self):
+        # launches HAProxy, or reloads it, and returns whether the new process is up
+        if not self.process:
+            logger.info("Launching HAProxy")
+            self.process = subprocess.Popen(self.command)
+            logger.info("HAProxy has been launched(PID: %s)", str(self.process.pid))
+            return True
+
+        wait = self._last_reload + self.min_interval - time.time()
+        if wait > 0:
+            logger.info("Delaying the reload of HAProxy by %.1f seconds", wait)
+            time.sleep(wait)
+        self._last_reload = time.time()
+
+        logger.info("Reloading HAProxy")
+        command = list(self.command)
+        if self.socket_handoff:
+            command.extend(["-x", self.stats_socket])
+        command.extend(["-sf", str(self.process.pid)])
+        start = time.time()
+        process = subprocess.Popen(command)
+        if not self._wait_ready(process):
+            logger.error("HAProxy(PID: %s) failed to start, PID %s keeps running", process.pid, self.process.pid)
+            if process.poll() is None:
+                process.terminate()
+            self._drain(process, stopping=True)
+            return False
+
+        self.last_latency = time.time() - start
+        self.reloads += 1
+        self._drain(self.process)
+        self.process = process
+        self._reap()
+        logger.info("HAProxy has been reloaded(PID: %s) in %d ms, %d old processes draining",
+                    str(process.pid), self.last_latency * 1000, self.stats()["draining"])
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"reloads": self.reloads, "draining": len(self._draining) - len(self._stopping),
+                    "stopping": len(self._stopping), "hard_stops": self.hard_stops, "last_latency": self.last_latency}
+
+    def _wait_ready(self, process):
+        # the new process is up once it answers on the stats socket
+        runtime = RuntimeApi(self.stats_socket, timeout=1)
+        deadline = time.time() + self.ready_timeout
+        while time.time() < deadline:
+            if process.poll() is not None:
+                return False
+            try:
+                if re.search(r"^Pid: %d$" % process.pid, runtime.execute("show info"), re.MULTILINE):
+                    return True
+            except RuntimeApiError:
+                pass
+            time.sleep(0.05)
+        return False
+
+    def _drain(self, process, stopping=False):
+        # the reaper thread waits for the process to exit
+        with self._lock:
+            self._draining[process.pid] = (process, time.time())
+            if stopping:
+                self._stopping.add(process.pid)
+        if not self._reaper:
+            self._reaper = threading.Thread(target=self._reap_forever, name="reaper")
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(1)
+            try:
+                self._reap()
+            except Exception as e:
+                logger.exception(e)
+
+    def _reap(self):
+        with self._lock:
+            now = time.time()
+            for pid, (process, since) in self._draining.items():
+                if process.poll() is not None:
+                    del self._draining[pid]
+                    self._stopping.discard(pid)
+                    logger.info("HAProxy(PID:%s) has been terminated", pid)
+                elif self.drain_timeout and now - since > self.drain_timeout and pid not in self._stopping:
+                    logger.info("HAProxy(PID:%s) is still draining after %d seconds, stopping it", pid,
+                                self.drain_timeout)
+                    self._hard_stop(pid, process)
+
+            running = [pid for pid in self._draining if pid not in self._stopping]
+            if self.max_draining and len(running) > self.max_draining:
+                for pid in running[:len(running) - self.max_draining]:
+                    logger.info("More than %d HAProxy processes are draining, stopping PID %s", self.max_draining, pid)
+                    self._hard_stop(pid, self._draining[pid][0])
+
+    def _hard_stop(self, pid, process):
+        try:
+            process.terminate()
+        except OSError:
+            pass
+        self._stopping.add(pid)
+        self.hard_stops += 1
@@ -0,0 +1,103 @@
+import logging
+import math
+import multiprocessing
+import os
+import resource
+
+logger = logging.getLogger("haproxy")
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_STATUS = "/proc/self/status"
+PROC_MEMINFO = "/proc/meminfo"
+
+
+def parse_cpu_list(text):
+    # '0-3,8,10-11' => [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for term in text.strip().split(","):
+        if not term:
+            continue
+        first, _, last = term.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_allowed_cpus():
+    # the CPUs the process may run on, as restricted by the cpuset of the container or its affinity
+    status = _read(PROC_STATUS) or ""
+    for line in status.splitlines():
+        if line.startswith("Cpus_allowed_list:"):
+            try:
+                return parse_cpu_list(line.split(":", 1)[1])
+            except ValueError:
+                break
+    try:
+        return range(multiprocessing.cpu_count())
+    except NotImplementedError:
+        return [0]
+
+
+def get_cpu_quota():
+    # the number of CPUs the CFS quota of the container amounts to, None if unlimited: cgroup v2 'cpu.max' holds
+    # '<quota> <period>' or 'max <period>', cgroup v1 splits them into two files
+    cpu_max = _read(os.path.join(CGROUP_ROOT, "cpu.max"))
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+    else:
+        for controller in ["cpu", "cpu,cpuacct", "cpuacct,cpu"]:
+            quota = _read(os.path.join(CGROUP_ROOT, controller, "cpu.cfs_quota_us"))
+            period = _read(os.path.join(CGROUP_ROOT, controller, "cpu.cfs_period_us"))
+            if quota and period:
+                break
+        else:
+            return None
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return float(quota) / period
+
+
+def detect_cpus():
+    # returns the CPUs available to the container and how many of them it can keep busy, the quota being rounded up
+    cpus = get_allowed_cpus()
+    count = len(cpus)
+    quota = get_cpu_quota()
+    if quota:
+        count = max(1, min(count, int(math.ceil(quota))))
+    logger.info("Available CPUs: %d (cpuset: %s, quota: %s)", count, ",".join(map(str, cpus)),
+                "%.2f" % quota if quota else "none")
+    return cpus, count
+
+
+def get_memory_limit():
+    # the memory limit of the container in bytes, or the memory of the host when it has none: cgroup v2 'memory.max'
+    # holds 'max' when unlimited, and the 'memory.limit_in_bytes' of cgroup v1 a number larger than the host memory
+    limits = []
+    for path in ["memory.max", os.path.join("memory", "memory.limit_in_bytes")]:
+        value = _read(os.path.join(CGROUP_ROOT, path))
+        if value and value.isdigit():
+            limits.append(int(value))
+    meminfo = _read(PROC_MEMINFO) or ""
+    for line in meminfo.splitlines():
+        # 'MemTotal:       16318908 kB'
+        if line.startswith("MemTotal:"):
+            limits.append(int(line.split()[1]) * 1024)
+            break
+    return min(limits) if limits else None
+
+
+def get_fd_limit():
+    # the hard limit on open files, up to which HAProxy raises its own limit, None if unlimited
+    hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+    return None if hard_limit == resource.RLIM_INFINITY else hard_limit
@@ -0,0 +1,93 @@
+import logging
+import socket
+
+logger = logging.getLogger("haproxy")
+
+
+class RuntimeApiError(Exception):
+    pass
+
+
+class RuntimeApi(object):
+    # Client of the HAProxy runtime API exposed on the admin-level stats socket
+    success_prefixes = ("IP changed", "no need to change")
+
+    def __init__(self, socket_path, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def execute(self, command):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall("%s\n" % command)
+            chunks = []
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except socket.error as e:
+            raise RuntimeApiError("%s: %s" % (command, e))
+        finally:
+            sock.close()
+        return "".join(chunks)
+
+    def apply(self, command):
+        # state changing commands answer with an empty line on success
+        response = self.execute(command).strip()
+        if response and not response.startswith(RuntimeApi.success_prefixes):
+            raise RuntimeApiError("%s: %s" % (command, response))
+        logger.info("Runtime API: %s", command)
+        return response
+
+
+class RuntimeSession(object):
+    # A persistent connection to the stats socket in interactive mode, where every response ends with a prompt. It is
+    # opened again when HAProxy has closed it, after a reload or an idle timeout.
+    prompt = "\n> "
+
+    def __init__(self, socket_path, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+
+    def execute(self, command):
+        if self.sock:
+            try:
+                return self._send(command)
+            except RuntimeApiError:
+                self.close()
+        self._connect()
+        return self._send(command)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.socket_path)
+            self._send("prompt")
+        except (socket.error, RuntimeApiError) as e:
+            self.close()
+            raise RuntimeApiError("%s: %s" % (self.socket_path, e))
+
+    def _send(self, command):
+        chunks = []
+        try:
+            self.sock.sendall("%s\n" % command)
+            tail = ""
+            while not tail.endswith(RuntimeSession.prompt):
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    raise RuntimeApiError("%s: connection closed" % command)
+                chunks.append(chunk)
+                tail = (tail + chunk)[-len(RuntimeSession.prompt):]
+        except socket.error as e:
+            raise RuntimeApiError("%s: %s" % (command, e))
+        return "".join(chunks)[:-len(RuntimeSession.prompt) + 1]
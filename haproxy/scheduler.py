@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger("haproxy")
+
+
+class Scheduler(object):
+    # Collapses bursts of reconfiguration requests into a single rebuild. A rebuild runs once no new request has
+    # arrived for `window` seconds, or `max_delay` seconds after the first pending request, whichever comes first.
+    # The callback receives the messages of the batch and the union of their service uris, or None if any request
+    # of the batch asked for a full rebuild.
+    # Requests are submitted by the websocket thread and never wait for a rebuild. At most `max_pending` of them are
+    # kept: beyond that the batch turns into a full rebuild, which covers any request that could come after.
+    def __init__(self, callback, window, max_delay, max_pending=1000):
+        self.callback = callback
+        self.window = window
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.events_received = 0
+        self.rebuilds_performed = 0
+        self.overflows = 0
+        self.max_queue_depth = 0
+        self.last_lag = 0
+        self._msgs = []
+        self._pending = 0
+        self._service_uris = set()
+        self._first_event = 0
+        self._last_event = 0
+        self._cond = threading.Condition()
+
+    def start(self):
+        worker = threading.Thread(target=self._run, name="scheduler")
+        worker.daemon = True
+        worker.start()
+
+    def submit(self, msg, service_uris=None):
+        with self._cond:
+            now = time.time()
+            if not self._pending:
+                self._first_event = now
+            self._last_event = now
+            self._pending += 1
+            self.events_received += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._pending)
+            if self._pending > self.max_pending:
+                if self._pending == self.max_pending + 1:
+                    self.overflows += 1
+                    logger.warning("More than %d events are pending, coalescing them into a full rebuild",
+                                   self.max_pending)
+                self._msgs = [msg]
+                self._service_uris = None
+            else:
+                self._msgs.append(msg)
+                if service_uris is None or self._service_uris is None:
+                    self._service_uris = None
+                else:
+                    self._service_uris.update(service_uris)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {"events_received": self.events_received,
+                    "rebuilds_performed": self.rebuilds_performed,
+                    "queue_depth": self._pending,
+                    "max_queue_depth": self.max_queue_depth,
+                    "overflows": self.overflows,
+                    "lag": self.last_lag}
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            while True:
+                deadline = min(self._last_event + self.window, self._first_event + self.max_delay)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            msgs, service_uris = self._msgs, self._service_uris
+            if self._pending > self.max_pending:
+                msgs = ["%s (full rebuild after %d pending events)" % (msgs[-1], self._pending)]
+            self.last_lag = time.time() - self._first_event
+            self._msgs = []
+            self._pending = 0
+            self._service_uris = set()
+            return msgs, service_uris
+
+    def _run(self):
+        while True:
+            msgs, service_uris = self._next_batch()
+            try:
+                self.callback(msgs, service_uris)
+            except Exception as e:
+                logger.exception(e)
+            self.rebuilds_performed += 1
+            logger.info("Events received: %(events_received)d, rebuilds performed: %(rebuilds_performed)d, "
+                        "queue depth: %(queue_depth)d (max %(max_queue_depth)d), lag: %(lag).2fs, "
+                        "overflows: %(overflows)d", self.stats())
@@ -0,0 +1,124 @@
+import cProfile
+import logging
+import pstats
+import threading
+import time
+from StringIO import StringIO
+
+logger = logging.getLogger("haproxy")
+
+
+class Span(object):
+    __slots__ = ("tracer", "name", "start", "entry")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.start = 0
+        self.entry = None
+
+    def __enter__(self):
+        self.entry = self.tracer.open_span(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.close_span(self.name, self.entry, time.time() - self.start)
+        return False
+
+
+class Tracer(object):
+    # Times the stages of the rebuilds. Every span adds to the totals by name in `timings`, and the spans of a trace,
+    # which covers a rebuild, are logged on a single line once it ends:
+    #   'rebuild 212 ms (fetch 48 ms, specs 3 ms, ssl 0 ms, config 80 ms (global 0 ms, tcp 0 ms, ...), ...)'
+    # A trace can also be profiled, always or once when requested, and the functions taking the most time are logged
+    # and dumped to `profile_file` for pstats.
+    def __init__(self):
+        self.timings = {}  # name => [count, seconds]
+        self.profile_all = False
+        self.profile_next = False
+        self.profile_file = None
+        self.profile_top = 20
+        self._local = threading.local()
+
+    def span(self, name):
+        return Span(self, name)
+
+    def trace(self, name):
+        return Trace(self, name)
+
+    def open_span(self, name):
+        # spans are kept for the trace of the current thread only, the others add to the totals
+        spans = getattr(self._local, "spans", None)
+        if spans is None:
+            return None
+        entry = [name, self._local.depth, 0]
+        spans.append(entry)
+        self._local.depth += 1
+        return entry
+
+    def close_span(self, name, entry, seconds):
+        timing = self.timings.setdefault(name, [0, 0])
+        timing[0] += 1
+        timing[1] += seconds
+        if entry is not None:
+            entry[2] = seconds
+            self._local.depth -= 1
+
+    @staticmethod
+    def format_spans(spans):
+        # [['rebuild', 0, 0.2], ['config', 1, 0.08], ['frontend', 2, 0.03]] =>
+        # 'rebuild 200 ms (config 80 ms (frontend 30 ms))'
+        text = ""
+        previous_depth = 0
+        for name, depth, seconds in spans:
+            if text:
+                text += " (" if depth > previous_depth else ")" * (previous_depth - depth) + ", "
+            text += "%s %d ms" % (name, seconds * 1000)
+            previous_depth = depth
+        return text + ")" * previous_depth
+
+
+class Trace(object):
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.span = Span(tracer, name)
+        self.profiler = None
+
+    def __enter__(self):
+        tracer = self.tracer
+        tracer._local.spans = []
+        tracer._local.depth = 0
+        if tracer.profile_all or tracer.profile_next:
+            tracer.profile_next = False
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.span.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.__exit__(exc_type, exc_value, traceback)
+        if self.profiler:
+            self.profiler.disable()
+        tracer = self.tracer
+        spans, tracer._local.spans = tracer._local.spans, None
+        logger.info("Rebuild timings: %s", Tracer.format_spans(spans))
+        if self.profiler:
+            self._report()
+        return False
+
+    def _report(self):
+        tracer = self.tracer
+        output = StringIO()
+        stats = pstats.Stats(self.profiler, stream=output)
+        stats.sort_stats("tottime").print_stats(tracer.profile_top)
+        logger.info("Rebuild profile, top %d functions:\n%s", tracer.profile_top, output.getvalue().strip())
+        if tracer.profile_file:
+            try:
+                stats.dump_stats(tracer.profile_file)
+                logger.info("Rebuild profile is saved to %s", tracer.profile_file)
+            except Exception as e:
+                logger.error(e)
+
+
+tracer = Tracer()
@@ -337,6 +337,30 @@ curl -sSfL --cacert ca0.pem ${DOCKER_HOST_IP} 2>&1 | grep -iF 'My hostname is we
 curl -sSIL --cacert ca0.pem ${DOCKER_HOST_IP} 2>&1 | grep -iF '301 Moved Permanently' > /dev/null
 echo
 
+echo "=> Test server slots"
+rm_container web-a web-b lb
+docker run -d --name web-a -e HOSTNAME=web-a -e VIRTUAL_HOST=web-a.org tutum/hello-world
+docker run -d --name web-b -e HOSTNAME=web-b -e VIRTUAL_HOST=web-b.org -e SERVER_SLOTS=1 tutum/hello-world
+docker run -d --name lb --link web-a:web-a --link web-b:web-b -e SERVER_SLOTS=4 -p 80:80 haproxy
+wait_for_startup http://${DOCKER_HOST_IP}
+curl -sSfL --resolve web-a.org:80:${DOCKER_HOST_IP} web-a.org 2>&1 | grep -iF 'My hostname is web-a' > /dev/null
+curl -sSfL --resolve web-b.org:80:${DOCKER_HOST_IP} web-b.org 2>&1 | grep -iF 'My hostname is web-b' > /dev/null
+echo
+
+echo "=> Test virtual host routed through a map file (with ACLs before HAProxy 1.6)"
+rm_container web-a web-b lb
+docker run -d --name web-a -e HOSTNAME=web-a -e VIRTUAL_HOST='web-a.org, web-a.com/pa' tutum/hello-world
+docker run -d --name web-b -e HOSTNAME=web-b -e VIRTUAL_HOST='web-b.org, *.web-b.org' tutum/hello-world
+docker run -d --name lb --link web-a:web-a --link web-b:web-b -e VHOST_ROUTING=map -p 80:80 haproxy
+wait_for_startup http://${DOCKER_HOST_IP}
+curl -sSfL --resolve web-a.org:80:${DOCKER_HOST_IP} web-a.org 2>&1 | grep -iF 'My hostname is web-a' > /dev/null
+curl -sSfL --resolve web-a.org:80:${DOCKER_HOST_IP} WEB-A.org:80 2>&1 | grep -iF 'My hostname is web-a' > /dev/null
+curl -sSfL --resolve web-a.com:80:${DOCKER_HOST_IP} web-a.com/pa 2>&1 | grep -iF 'My hostname is web-a' > /dev/null
+curl -sSfL --resolve web-b.org:80:${DOCKER_HOST_IP} web-b.org 2>&1 | grep -iF 'My hostname is web-b' > /dev/null
+curl -sSfL --resolve www.web-b.org:80:${DOCKER_HOST_IP} www.web-b.org 2>&1 | grep -iF 'My hostname is web-b' > /dev/null
+curl -sSL --resolve web-c.org:80:${DOCKER_HOST_IP} web-c.org 2>&1 | grep -iF '503 Service Unavailable' > /dev/null
+echo
+
 echo "=> Clean up"
 cleanup
 echo "=> Done!"
\ No newline at end of file
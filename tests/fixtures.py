@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haproxy"))
+
+from haproxy import Haproxy
+
+CONTAINER_URI = "/api/v1/container/haproxy/"
+SERVICE_URI = "/api/v1/service/haproxy/"
+
+
+class TutumObject(object):
+    # Stands in for the objects returned by tutum.Utils.fetch_by_resource_uri
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+def service_uri(name):
+    return "/api/v1/service/%s/" % name
+
+
+def tutum_topology(services, envvars=None):
+    # services: {'web-a': 2, ...} => the HAProxy container and service objects linking `services` with that many
+    # containers each, and the environment variables `envvars` set on HAProxy, such as 'WEB_A_ENV_VIRTUAL_HOST'
+    container_envvars = []
+    container_links = []
+    service_links = []
+    for i, (name, containers) in enumerate(sorted(services.iteritems())):
+        alias = name.upper().replace("-", "_")
+        service_links.append({"name": name, "to_service": service_uri(name)})
+        for j in range(1, containers + 1):
+            addr = "10.0.%d.%d" % (i, j)
+            container_envvars.append({"key": "%s_%d_PORT_80_TCP" % (alias, j), "value": "tcp://%s:80" % addr})
+            container_links.append({"name": "%s-%d" % (name, j), "endpoints": {"80/tcp": "tcp://%s:80" % addr},
+                                    "to_container": "/api/v1/container/%s-%d/" % (name, j)})
+    for key, value in sorted((envvars or {}).iteritems()):
+        container_envvars.append({"key": key, "value": value})
+    container = TutumObject(resource_uri=CONTAINER_URI, container_envvars=container_envvars,
+                            linked_to_container=container_links)
+    service = TutumObject(resource_uri=SERVICE_URI, linked_to_service=service_links)
+    return container, service
+
+
+def reset_haproxy(version=(1, 8)):
+    # Drops the state kept between two updates, and runs Haproxy in Tutum mode against the given HAProxy version
+    Haproxy.cls_container_uri = CONTAINER_URI
+    Haproxy.cls_service_uri = SERVICE_URI
+    Haproxy.cls_tutum_auth = "ApiKey test:test"
+    Haproxy.cls_haproxy_version = version
+    Haproxy.cls_specs = None
+    Haproxy.cls_cfg_dict = None
+    Haproxy.cls_maps = {}
+    Haproxy.cls_sections = {}
+    Haproxy.cls_server_slots = {}
+    Haproxy.cls_vhost_routing = None
+
+
+def build_config(container, service, service_uris=None):
+    # Returns the configuration a rebuild generates for the given objects, without writing it nor running HAProxy
+    Haproxy.fetch_tutum_objs = classmethod(lambda cls, uris: [container, service])
+    haproxy = Haproxy(service_uris)
+    haproxy._config_ssl()
+    return haproxy._config()
@@ -0,0 +1,52 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haproxy"))
+
+import main
+from api import ApiClient, ApiError
+
+
+class FakeScheduler(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, msg, service_uris=None):
+        self.submitted.append((msg, service_uris))
+
+
+class LinkCheckTest(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger("haproxy").setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.getLogger("haproxy").setLevel(logging.NOTSET)
+
+    def test_fetch_async_calls_errback_once_the_retries_are_exhausted(self):
+        api = ApiClient("http://127.0.0.1:1/", {}, timeout=0.1, budget=0.3, backoff=0.01, max_backoff=0.05)
+        done = threading.Event()
+        results = []
+
+        def record(result):
+            results.append(result)
+            done.set()
+
+        api.fetch_async("/api/v1/service/haproxy/", record, record)
+        self.assertTrue(done.wait(5))
+        self.assertIsInstance(results[0], ApiError)
+
+    def test_failed_link_check_schedules_a_full_rebuild(self):
+        scheduler, main.scheduler = main.scheduler, FakeScheduler()
+        try:
+            main.check_linked_services_failed(ApiError("GET /api/v1/service/haproxy/: timed out"))
+            self.assertEqual(len(main.scheduler.submitted), 1)
+            self.assertIsNone(main.scheduler.submitted[0][1])
+        finally:
+            main.scheduler = scheduler
+
+
+if __name__ == "__main__":
+    unittest.main()
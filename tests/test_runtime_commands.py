@@ -0,0 +1,68 @@
+import unittest
+from collections import OrderedDict
+
+from fixtures import Haproxy, reset_haproxy
+
+BACKEND = "backend SERVICE_WEB"
+SLOTS = ["server slot1 10.0.0.1:80 check",
+         "server slot2 10.0.0.2:80 check",
+         "server slot3 127.0.0.1:1 check disabled"]
+
+
+def config(servers, others=("balance roundrobin",)):
+    return OrderedDict([("frontend port_80", ["bind :80", "default_backend SERVICE_WEB"]),
+                        (BACKEND, list(others) + list(servers))])
+
+
+class RuntimeCommandsTest(unittest.TestCase):
+    def setUp(self):
+        reset_haproxy((1, 8))
+
+    def assertCommands(self, new_servers, commands):
+        self.assertEqual(Haproxy._runtime_commands(config(SLOTS), config(new_servers)), commands)
+
+    def test_unchanged_configuration_needs_no_command(self):
+        self.assertCommands(SLOTS, [])
+
+    def test_filling_a_slot_readdresses_and_enables_it(self):
+        self.assertCommands(SLOTS[:2] + ["server slot3 10.0.0.3:80 check"],
+                            ["set server SERVICE_WEB/slot3 addr 10.0.0.3 port 80",
+                             "enable server SERVICE_WEB/slot3"])
+
+    def test_releasing_a_slot_disables_it_before_readdressing_it(self):
+        self.assertCommands(["server slot1 127.0.0.1:1 check disabled"] + SLOTS[1:],
+                            ["disable server SERVICE_WEB/slot1",
+                             "set server SERVICE_WEB/slot1 addr 127.0.0.1 port 1"])
+
+    def test_weight_change(self):
+        self.assertCommands(["server slot1 10.0.0.1:80 weight 5 check"] + SLOTS[1:],
+                            ["set weight SERVICE_WEB/slot1 5"])
+
+    def test_removed_server_is_disabled(self):
+        self.assertCommands(SLOTS[1:], ["disable server SERVICE_WEB/slot1"])
+
+    def test_structural_changes_need_a_reload(self):
+        old_cfg = config(SLOTS)
+        for new_cfg in [config(SLOTS + ["server slot4 127.0.0.1:1 check disabled"]),
+                        config(["server slot1 10.0.0.1:80 check inter 1000"] + SLOTS[1:]),
+                        config(SLOTS, others=["balance source"]),
+                        OrderedDict(config(SLOTS), **{"backend SERVICE_API": SLOTS})]:
+            self.assertIsNone(Haproxy._runtime_commands(old_cfg, new_cfg))
+        self.assertIsNone(Haproxy._runtime_commands(None, old_cfg))
+
+    def test_frontend_changes_need_a_reload(self):
+        new_cfg = config(SLOTS)
+        new_cfg["frontend port_80"] = ["bind :80", "default_backend SERVICE_API"]
+        self.assertIsNone(Haproxy._runtime_commands(config(SLOTS), new_cfg))
+
+    def test_address_change_needs_a_reload_before_1_8(self):
+        reset_haproxy((1, 5))
+        self.assertCommands(SLOTS[:2] + ["server slot3 10.0.0.3:80 check"], None)
+        self.assertCommands(["server slot1 10.0.0.1:80 weight 5 check"] + SLOTS[1:],
+                            ["set weight SERVICE_WEB/slot1 5"])
+        self.assertCommands(SLOTS[:1] + ["server slot2 10.0.0.2:80 check disabled"] + SLOTS[2:],
+                            ["disable server SERVICE_WEB/slot2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
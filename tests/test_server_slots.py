@@ -0,0 +1,47 @@
+import unittest
+
+from fixtures import Haproxy, build_config, reset_haproxy, service_uri, tutum_topology
+
+ENVVARS = {"WEB_A_ENV_VIRTUAL_HOST": "web-a.org", "WEB_A_ENV_SERVER_SLOTS": "2"}
+
+
+class ServerSlotsTest(unittest.TestCase):
+    def setUp(self):
+        reset_haproxy()
+
+    def scale(self, containers):
+        return build_config(*tutum_topology({"web-a": containers}, ENVVARS), service_uris=[service_uri("web-a")])
+
+    def servers(self, cfg):
+        return [line for line in cfg["backend SERVICE_WEB_A"] if line.startswith("server ")]
+
+    def test_scale_up_and_down_within_free_slots_is_applied_at_runtime(self):
+        cfg = self.scale(2)
+        self.assertEqual(len(self.servers(cfg)), 4)
+        for containers in [3, 4, 3, 2, 1]:
+            new_cfg = self.scale(containers)
+            self.assertEqual(len(self.servers(new_cfg)), 4)
+            self.assertTrue(Haproxy._runtime_commands(cfg, new_cfg), "%d containers need a reload" % containers)
+            cfg = new_cfg
+
+    def test_pool_grows_when_the_containers_do_not_fit(self):
+        cfg = self.scale(2)
+        self.scale(4)
+        new_cfg = self.scale(5)
+        self.assertIsNone(Haproxy._runtime_commands(cfg, new_cfg))
+        servers = self.servers(new_cfg)
+        self.assertEqual(len(servers), 7)
+        self.assertEqual(len([server for server in servers if server.endswith(" disabled")]), 2)
+
+    def test_containers_keep_their_slots(self):
+        servers = self.servers(self.scale(3))
+        self.assertEqual(self.servers(self.scale(2))[:2], servers[:2])
+        self.assertEqual(self.servers(self.scale(3)), servers)
+
+    def test_pool_is_trimmed_when_mostly_free(self):
+        self.scale(9)
+        self.assertEqual(len(self.servers(self.scale(1))), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+
+from fixtures import service_uri, tutum_topology
+from parser import Specs
+
+SERVICES = {"web-a": 2, "web-b": 2, "web-c": 1}
+
+
+def topology(vhost_a="http://shared.org", vhost_b="http://shared.org", vhost_c="http://c.org"):
+    return tutum_topology(SERVICES, {"WEB_A_ENV_VIRTUAL_HOST": vhost_a, "WEB_B_ENV_VIRTUAL_HOST": vhost_b,
+                                     "WEB_C_ENV_VIRTUAL_HOST": vhost_c})
+
+
+def routes(specs, service_alias):
+    return sorted(route.container_name for route in specs.get_routes().get(service_alias, []))
+
+
+class SpecsTest(unittest.TestCase):
+    def assertSameAsFullParse(self, specs, container, service):
+        full = Specs(container, service)
+        self.assertEqual(specs.get_details(), full.get_details())
+        self.assertEqual(specs.get_routes(), full.get_routes())
+        self.assertEqual(specs.get_vhosts(), full.get_vhosts())
+
+    def test_services_sharing_a_vhost_are_merged_into_the_first_alias(self):
+        specs = Specs(*topology())
+        self.assertEqual(specs.merged, {"WEB_B": "WEB_A"})
+        self.assertEqual(sorted(specs.get_service_aliases()), ["WEB_A", "WEB_C"])
+        self.assertEqual(routes(specs, "WEB_A"), ["WEB_A_1", "WEB_A_2", "WEB_B_1", "WEB_B_2"])
+        self.assertEqual(specs.dirty, set(["WEB_A", "WEB_B", "WEB_C"]))
+
+    def test_unmerge_marks_the_former_merge_target_dirty(self):
+        specs = Specs(*topology())
+        revision = specs.get_revision("WEB_A")
+        container, service = topology(vhost_b="http://b.org")
+        specs.update(container, service, [service_uri("web-b")])
+        self.assertEqual(specs.dirty, set(["WEB_A", "WEB_B"]))
+        self.assertGreater(specs.get_revision("WEB_A"), revision)
+        self.assertEqual(routes(specs, "WEB_A"), ["WEB_A_1", "WEB_A_2"])
+        self.assertEqual(routes(specs, "WEB_B"), ["WEB_B_1", "WEB_B_2"])
+        self.assertSameAsFullParse(specs, container, service)
+
+    def test_merge_target_leaving_hands_the_vhost_over(self):
+        specs = Specs(*topology())
+        container, service = topology(vhost_a="http://a.org")
+        specs.update(container, service, [service_uri("web-a")])
+        self.assertEqual(specs.dirty, set(["WEB_A", "WEB_B"]))
+        self.assertEqual(specs.merged, {})
+        self.assertEqual(routes(specs, "WEB_B"), ["WEB_B_1", "WEB_B_2"])
+        self.assertSameAsFullParse(specs, container, service)
+
+    def test_merge_marks_the_merge_target_dirty(self):
+        specs = Specs(*topology(vhost_b="http://b.org"))
+        container, service = topology()
+        specs.update(container, service, [service_uri("web-b")])
+        self.assertEqual(specs.dirty, set(["WEB_A", "WEB_B"]))
+        self.assertEqual(routes(specs, "WEB_A"), ["WEB_A_1", "WEB_A_2", "WEB_B_1", "WEB_B_2"])
+        self.assertSameAsFullParse(specs, container, service)
+
+    def test_change_of_a_merged_service_marks_its_merge_target_dirty(self):
+        specs = Specs(*topology())
+        container, service = topology()
+        container.linked_to_container = [link for link in container.linked_to_container if link["name"] != "web-b-2"]
+        specs.update(container, service, [service_uri("web-b")])
+        self.assertEqual(specs.dirty, set(["WEB_A", "WEB_B"]))
+        self.assertEqual(routes(specs, "WEB_A"), ["WEB_A_1", "WEB_A_2", "WEB_B_1"])
+        self.assertSameAsFullParse(specs, container, service)
+
+    def test_unrelated_services_stay_clean(self):
+        specs = Specs(*topology())
+        revisions = dict((alias, specs.get_revision(alias)) for alias in ["WEB_A", "WEB_B"])
+        container, service = topology(vhost_c="http://c.com")
+        specs.update(container, service, [service_uri("web-c")])
+        self.assertEqual(specs.dirty, set(["WEB_C"]))
+        self.assertEqual(dict((alias, specs.get_revision(alias)) for alias in ["WEB_A", "WEB_B"]), revisions)
+        self.assertSameAsFullParse(specs, container, service)
+
+    def test_update_without_changes_is_clean(self):
+        specs = Specs(*topology())
+        version = specs.version
+        specs.update(*(topology() + ([service_uri("web-a")],)))
+        self.assertEqual(specs.dirty, set())
+        self.assertEqual(specs.version, version)
+
+
+if __name__ == "__main__":
+    unittest.main()